@@ -7,10 +7,19 @@ import matplotlib.pyplot as plt
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning)  # Suppress matplotlib warnings
 warnings.filterwarnings('ignore', category=FutureWarning)  # Suppress future warnings
-from scipy.fft import fft  # Use scipy.fft instead of deprecated scipy.fftpack
+from scipy.fft import fft, rfft  # Use scipy.fft instead of deprecated scipy.fftpack
+from scipy.signal import firwin, upfirdn
 import sqlite3
 import os
-from collections import defaultdict
+import json
+import urllib.parse
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 import librosa
 import librosa.display  # Explicitly import display module
@@ -85,30 +94,386 @@ class AudioRecorder:
             self.p.terminate()
 
 class AudioAnalyzer:
-    def __init__(self, chunk_size=4096, rate=44100):
+    # Fingerprinting engines: "stft" frames the whole signal and runs one
+    # batched FFT, "chunked" is the original chunk-by-chunk loop
+    ENGINES = ("stft", "chunked")
+    # Analyzer of a process pool worker, created by init_worker
+    worker = None
+    # Fingerprint schemes: 1 hashes the absolute chunk index (legacy, only
+    # matches clips aligned to the start of the song), 2 hashes the time
+    # delta between the paired peaks so any part of a song can be matched,
+    # 3 bit-packs the same quantized values into an integer instead of MD5
+    FINGERPRINT_VERSIONS = (1, 2, 3)
+    LATEST_FINGERPRINT_VERSION = 3
+    # Version 3 key layout: freq1 | freq2 | time delta (32 bits in total)
+    HASH_FREQ_BITS = 10
+    HASH_DELTA_BITS = 12
+    # Peak pairing modes: "adjacent" pairs neighbouring peaks within a frame
+    # (original behaviour), "target_zone" pairs each anchor peak with the
+    # strongest peaks in a window over the following frames
+    PAIRINGS = ("adjacent", "target_zone")
+    # Units of stored fingerprint offsets: integer frame indices. Databases
+    # from before this stored seconds, which are converted when opened.
+    OFFSET_UNITS = ("frames",)
+    
+    # Settings that change which fingerprints are produced. They are recorded
+    # per database so ingestion and queries always agree.
+    CONFIG_KEYS = ("fingerprint_version", "chunk_size", "hop_size", "rate",
+                   "decimate", "offset_unit", "pairing", "fan_value",
+                   "target_zone_start", "target_zone_frames", "target_zone_freq")
+    # Values of those settings from before they were configurable, used for
+    # databases that predate them
+    LEGACY_CONFIG = {"fingerprint_version": 1, "chunk_size": 4096, "hop_size": 4096,
+                     "rate": 44100, "decimate": False, "offset_unit": "seconds",
+                     "pairing": "adjacent"}
+    # Lowest sample rate the decimating front end may analyse at. Peaks are
+    # only searched up to 2 kHz, so this leaves ample headroom.
+    DECIMATE_RATE = 8000
+    # Bytes read at a time when looking for the data chunk of a WAV file
+    WAV_HEADER_READ = 4096
+    
+    def __init__(self, chunk_size=4096, rate=44100, engine="stft",
+                 fingerprint_version=LATEST_FINGERPRINT_VERSION, hop_size=None,
+                 decimate=False, offset_unit="frames", pairing="target_zone",
+                 fan_value=5, target_zone_start=1, target_zone_frames=10,
+                 target_zone_freq=1000, verbose=True):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown fingerprint engine: {engine}")
+        if fingerprint_version not in self.FINGERPRINT_VERSIONS:
+            raise ValueError(f"Unknown fingerprint version: {fingerprint_version}")
+        if pairing not in self.PAIRINGS:
+            raise ValueError(f"Unknown peak pairing mode: {pairing}")
+        if pairing == "target_zone" and fingerprint_version == 1:
+            raise ValueError("Target zone pairing requires fingerprint version 2 or later")
+        if offset_unit not in self.OFFSET_UNITS:
+            raise ValueError(f"Unknown offset unit: {offset_unit}")
+        
         self.CHUNK_SIZE = chunk_size
+        # Frames overlap by CHUNK_SIZE - HOP_SIZE samples (half by default)
+        self.HOP_SIZE = hop_size or chunk_size // 2
         self.RATE = rate
+        # With decimation, audio is low-passed and downsampled by DECIMATION
+        # before framing. Frame sizes shrink by the same factor, so frame
+        # timing and FFT bin frequencies stay the same. Peaks match the full
+        # band analysis only for audio with no energy above the analysis
+        # Nyquist frequency; otherwise extra, weaker peaks are found.
+        self.decimate = decimate
+        self.DECIMATION = self._decimation_factor() if decimate else 1
+        self.FRAME_SIZE = self.CHUNK_SIZE // self.DECIMATION
+        self.FRAME_HOP = self.HOP_SIZE // self.DECIMATION
+        self.ANALYSIS_RATE = self.RATE / self.DECIMATION
         # Improved frequency ranges for better fingerprinting
         self.RANGES = [40, 80, 120, 180, 300, 500, 1000, 2000]
         self.FUZ_FACTOR = 2
+        # Number of frames transformed per batched FFT call (bounds memory)
+        self.FRAME_BATCH = 512
+        # Number of anchor peaks paired per vectorized step (bounds memory)
+        self.PAIR_BATCH = 4096
+        # Number of samples read per block when streaming audio files
+        self.BLOCK_SIZE = 65536
+        self.engine = engine
+        self.fingerprint_version = fingerprint_version
+        self.offset_unit = offset_unit
+        self.pairing = pairing
+        self.fan_value = fan_value
+        self.target_zone_start = target_zone_start
+        self.target_zone_frames = target_zone_frames
+        self.target_zone_freq = target_zone_freq
+        # Progress messages are printed only when verbose
+        self.verbose = verbose
+        self._windows = {}
+        self._decimation_taps = None
+    
+    def _decimation_factor(self):
+        """Largest downsampling factor that keeps the analysis rate above
+        DECIMATE_RATE and divides both the chunk and hop sizes"""
+        for factor in range(int(self.RATE // self.DECIMATE_RATE), 1, -1):
+            if self.CHUNK_SIZE % factor == 0 and self.HOP_SIZE % factor == 0:
+                return factor
+        return 1
+    
+    def get_config(self):
+        """Get the settings that determine which fingerprints are produced"""
+        return {
+            "fingerprint_version": self.fingerprint_version,
+            "chunk_size": self.CHUNK_SIZE,
+            "hop_size": self.HOP_SIZE,
+            "rate": self.RATE,
+            "decimate": self.decimate,
+            "offset_unit": self.offset_unit,
+            "pairing": self.pairing,
+            "fan_value": self.fan_value,
+            "target_zone_start": self.target_zone_start,
+            "target_zone_frames": self.target_zone_frames,
+            "target_zone_freq": self.target_zone_freq,
+        }
         
     def read_audio(self, filename):
         """Read audio file with support for multiple formats"""
         try:
-            # Try reading as WAV first
-            if filename.endswith('.wav'):
-                wf = wave.open(filename, 'rb')
-                frames = wf.readframes(wf.getnframes())
-                audio = np.frombuffer(frames, dtype=np.int16)
-                wf.close()
-                return audio
-            else:
-                # Use librosa for other formats
-                audio, sr = librosa.load(filename, sr=self.RATE, mono=True)
-                return (audio * 32767).astype(np.int16)  # Convert to int16
+            wav = self._map_native_wav(filename)
+            if wav is not None:
+                # Mono 16-bit files come back as a zero-copy view of the file
+                data, sample_width, channels, _ = wav
+                return self._pcm_to_mono(data, sample_width, channels)
+            
+            blocks = list(self.stream_audio(filename))
+            return np.concatenate(blocks) if blocks else np.empty(0, dtype=np.int16)
+        except Exception as e:
+            print(f"Error reading audio file {filename}: {e}")
+            return None
+    
+    def stream_audio(self, filename, block_size=None):
+        """Yield any supported audio file as mono int16 blocks at RATE
+        
+        PCM WAV files already at RATE are memory-mapped. Everything else is
+        decoded by ffmpeg straight into memory through a pipe, or by librosa
+        when ffmpeg is not installed. No intermediate files are written.
+        """
+        wav = self._map_native_wav(filename)
+        if wav is not None:
+            yield from self._iter_pcm_blocks(*wav[:3], block_size)
+        elif which("ffmpeg") is not None:
+            yield from self.stream_ffmpeg(filename, block_size)
+        else:
+            audio, sr = librosa.load(filename, sr=self.RATE, mono=True)
+            yield (audio * 32767).astype(np.int16)  # Convert to int16
+    
+    def stream_wav(self, filename, block_size=None):
+        """Yield the audio of a WAV file as mono int16 blocks
+        
+        Reads block_size samples (BLOCK_SIZE by default) at a time instead of
+        the whole file, so memory use does not grow with file length.
+        """
+        data, sample_width, channels, _ = self.map_wav(filename)
+        yield from self._iter_pcm_blocks(data, sample_width, channels, block_size)
+    
+    def stream_ffmpeg(self, filename, block_size=None):
+        """Decode any format ffmpeg supports into mono int16 blocks at RATE
+        
+        PCM is read from ffmpeg's stdout as it is produced, so the decoded
+        file is never held in memory or written to disk as a whole.
+        """
+        block_bytes = (block_size or self.BLOCK_SIZE) * 2
+        command = [
+            "ffmpeg", "-nostdin", "-v", "error", "-i", filename,
+            "-f", "s16le", "-acodec", "pcm_s16le",
+            "-ac", "1", "-ar", str(self.RATE), "pipe:1",
+        ]
+        
+        # stderr goes to an anonymous file so a chatty decoder cannot fill
+        # the pipe and stall while we are reading stdout
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+            try:
+                while True:
+                    data = process.stdout.read(block_bytes)
+                    if not data:
+                        break
+                    yield np.frombuffer(data, dtype='<i2', count=len(data) // 2)
+                
+                if process.wait() != 0:
+                    errors.seek(0)
+                    message = errors.read().decode(errors='replace').strip()
+                    raise RuntimeError(f"ffmpeg could not decode {filename}: {message}")
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+    
+    def _map_native_wav(self, filename):
+        """Memory-map a PCM WAV file if it can be used without resampling
+        
+        Returns the map_wav result, or None for other files.
+        """
+        if not filename.lower().endswith('.wav'):
+            return None
+        try:
+            wav = self.map_wav(filename)
+        except ValueError:
+            return None
+        return wav if wav[3] == self.RATE else None
+    
+    def _iter_pcm_blocks(self, data, sample_width, channels, block_size=None):
+        """Split mapped PCM data into mono int16 blocks of block_size samples"""
+        block_bytes = (block_size or self.BLOCK_SIZE) * sample_width * channels
+        for start in range(0, len(data), block_bytes):
+            yield self._pcm_to_mono(data[start:start + block_bytes], sample_width, channels)
+    
+    def map_wav(self, filename):
+        """Memory-map the sample data of a PCM WAV file
+        
+        Parses the RIFF header with parse_wav_header and returns (data,
+        sample_width, channels, frame_rate), where data is a read-only
+        np.memmap of the raw bytes of the data chunk. Pages are shared
+        through the OS page cache rather than copied into the Python heap.
+        """
+        file_size = os.path.getsize(filename)
+        header = None
+        with open(filename, 'rb') as f:
+            data = b''
+            read_size = self.WAV_HEADER_READ
+            while header is None:
+                block = f.read(read_size)
+                if not block:
+                    raise ValueError("WAV file has no data chunk")
+                data += block
+                header = self.parse_wav_header(data)
+                read_size *= 2
+        
+        sample_width, channels, frame_rate, offset, size = header
+        frame_bytes = sample_width * channels
+        # Streaming writers may leave the size unset, so clamp to the file
+        size = min(size if size is not None else file_size, file_size - offset)
+        size -= size % frame_bytes
+        if size <= 0:
+            return np.empty(0, dtype=np.uint8), sample_width, channels, frame_rate
+        
+        data = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=(size,))
+        return data, sample_width, channels, frame_rate
+    
+    @staticmethod
+    def parse_wav_header(data):
+        """Parse the RIFF header at the start of a PCM WAV byte string
+        
+        For WAV data that arrives incrementally. Returns (sample_width,
+        channels, frame_rate, data_offset, data_size), or None if data does
+        not reach the data chunk yet. data_size is None when the writer left
+        it unset (streaming writers often do).
+        """
+        if len(data) < 12:
+            return None
+        if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+            raise ValueError("Not a RIFF/WAVE file")
+        
+        fmt = None
+        position = 12
+        while position + 8 <= len(data):
+            chunk_id, size = struct.unpack_from('<4sI', data, position)
+            position += 8
+            if chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("WAV data chunk precedes its fmt chunk")
+                format_tag, channels, frame_rate, _, _, bits = fmt
+                if channels < 1 or bits < 1:
+                    raise ValueError("WAV fmt chunk has no channels or sample bits")
+                if size in (0, 0xFFFFFFFF):
+                    size = None
+                return (bits + 7) // 8, channels, frame_rate, position, size
+            
+            if position + size > len(data):
+                return None
+            if chunk_id == b'fmt ':
+                if size < 16:
+                    raise ValueError("WAV fmt chunk is too short")
+                fmt = struct.unpack_from('<HHIIHH', data, position)
+                format_tag = fmt[0]
+                if format_tag == 0xFFFE and size >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE: the real format is in the sub-format GUID
+                    format_tag = struct.unpack_from('<H', data, position + 24)[0]
+                if format_tag != 1:
+                    raise ValueError(f"Unsupported WAV format tag: {format_tag:#x}")
+            # Chunks are padded to an even number of bytes
+            position += size + (size & 1)
+        return None
+    
+    @staticmethod
+    def _pcm_to_mono(frames, sample_width, channels):
+        """Convert interleaved PCM bytes to mono int16 samples
+        
+        Mono 16-bit input is returned as a view without copying.
+        """
+        if sample_width == 2:
+            audio = np.frombuffer(frames, dtype='<i2')
+        elif sample_width == 1:
+            # 8-bit WAV samples are unsigned
+            audio = (np.frombuffer(frames, dtype=np.uint8).astype(np.int16) - 128) << 8
+        elif sample_width == 3:
+            # Keep the two most significant bytes of each 24-bit sample
+            audio = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)[:, 1:]
+            audio = np.ascontiguousarray(audio).view('<i2').ravel()
+        elif sample_width == 4:
+            audio = (np.frombuffer(frames, dtype='<i4') >> 16).astype(np.int16)
+        else:
+            raise ValueError(f"Unsupported sample width: {sample_width} bytes")
+        
+        if channels > 1:
+            # Average the interleaved channels
+            audio = audio.reshape(-1, channels).sum(axis=1, dtype=np.int32) // channels
+            audio = audio.astype(np.int16)
+        return audio
+    
+    def fingerprint_file(self, filename):
+        """Fingerprint an audio file
+        
+        The audio is decoded and fingerprinted block by block (see
+        stream_audio). Returns (fingerprints, duration in seconds), or None
+        if the file cannot be read.
+        """
+        result = self.fingerprint_arrays(filename)
+        if result is None:
+            return None
+        
+        hashes, offsets, duration = result
+        fingerprints = list(zip(hashes.tolist(), offsets.tolist()))
+        if self.verbose:
+            print(f"Generated {len(fingerprints)} fingerprints")
+        return fingerprints, duration
+    
+    def fingerprint_arrays(self, filename):
+        """Fingerprint an audio file into compact arrays
+        
+        Returns (hashes, offsets, duration in seconds), or None if the file
+        cannot be read.
+        """
+        stream = FingerprintStream(self)
+        hashes, offsets = [], []
+        try:
+            for block in self.stream_audio(filename):
+                block_hashes, block_offsets = stream.feed(block)
+                hashes.append(block_hashes)
+                offsets.append(block_offsets)
         except Exception as e:
             print(f"Error reading audio file {filename}: {e}")
             return None
+        
+        block_hashes, block_offsets = stream.flush()
+        hashes.append(block_hashes)
+        offsets.append(block_offsets)
+        
+        return np.concatenate(hashes), np.concatenate(offsets), stream.num_samples / self.RATE
+    
+    @classmethod
+    def init_worker(cls, config):
+        """Process pool initializer that creates the worker's analyzer from get_config()"""
+        AudioAnalyzer.worker = cls(**config, verbose=False)
+    
+    @staticmethod
+    def fingerprint_in_worker(filename):
+        """Run fingerprint_arrays on the analyzer of a worker process"""
+        return AudioAnalyzer.worker.fingerprint_arrays(filename)
+    
+    def fingerprint_wav_bytes(self, data):
+        """Fingerprint a PCM WAV file held in memory
+        
+        The audio must be sampled at RATE. Returns (hashes, offsets,
+        duration in seconds), like fingerprint_arrays.
+        """
+        header = self.parse_wav_header(data)
+        if header is None:
+            raise ValueError("WAV data ends before its data chunk")
+        sample_width, channels, frame_rate, offset, size = header
+        if frame_rate != self.RATE:
+            raise ValueError(f"WAV data must be sampled at {self.RATE} Hz, not {frame_rate} Hz")
+        
+        end = len(data) if size is None else min(len(data), offset + size)
+        end -= (end - offset) % (sample_width * channels)
+        samples = self._pcm_to_mono(memoryview(data)[offset:end], sample_width, channels)
+        
+        stream = FingerprintStream(self)
+        hashes, offsets = zip(stream.feed(samples), stream.flush())
+        return np.concatenate(hashes), np.concatenate(offsets), stream.num_samples / self.RATE
     
     def convert_audio_format(self, input_file, output_file=None):
         """Convert audio file to WAV format"""
@@ -129,10 +494,18 @@ class AudioAnalyzer:
             print("Try installing ffmpeg: brew install ffmpeg (macOS) or apt install ffmpeg (Linux)")
             return None
     
+    def get_window(self, size):
+        """Get a cached Hamming window of the given length"""
+        window = self._windows.get(size)
+        if window is None:
+            window = np.hamming(size)
+            self._windows[size] = window
+        return window
+    
     def get_fft(self, data):
         """Compute FFT with windowing for better frequency resolution"""
         # Apply Hamming window to reduce spectral leakage
-        windowed_data = data * np.hamming(len(data))
+        windowed_data = data * self.get_window(len(data))
         fft_data = fft(windowed_data)
         # Handle both complex and real FFT results
         if np.iscomplexobj(fft_data):
@@ -141,6 +514,66 @@ class AudioAnalyzer:
             fft_data = fft_data[0:len(fft_data)//2]
         return fft_data
     
+    def decimate_audio(self, audio_data):
+        """Low-pass filter and downsample audio to the analysis rate
+        
+        Returns the audio unchanged when decimation is disabled.
+        """
+        factor = self.DECIMATION
+        if factor == 1:
+            return audio_data
+        
+        # Polyphase filtering only computes the samples that are kept
+        filtered = upfirdn(self.get_decimation_taps(), np.asarray(audio_data, dtype=np.float64),
+                           down=factor)
+        return filtered[4:4 + len(audio_data) // factor]
+    
+    def get_decimation_taps(self):
+        """Get the cached anti-aliasing filter used for decimation
+        
+        A linear-phase FIR of 8 * DECIMATION + 1 taps, so its delay is
+        exactly 4 samples at the analysis rate.
+        """
+        if self._decimation_taps is None:
+            self._decimation_taps = firwin(8 * self.DECIMATION + 1, 1.0 / self.DECIMATION)
+        return self._decimation_taps
+    
+    def count_frames(self, num_samples):
+        """Number of complete analysis frames in a signal of num_samples
+        
+        num_samples is counted at the analysis rate (after decimation).
+        """
+        if num_samples < self.FRAME_SIZE:
+            return 0
+        return 1 + (num_samples - self.FRAME_SIZE) // self.FRAME_HOP
+    
+    def frame_audio(self, audio_data):
+        """Split audio into overlapping frames using a zero-copy strided view
+        
+        Frame i covers samples [i * FRAME_HOP, i * FRAME_HOP + FRAME_SIZE) of
+        audio at the analysis rate. Without decimation these are the same as
+        HOP_SIZE and CHUNK_SIZE.
+        """
+        audio_data = np.ascontiguousarray(audio_data)
+        num_frames = self.count_frames(len(audio_data))
+        if num_frames == 0:
+            return np.empty((0, self.FRAME_SIZE), dtype=audio_data.dtype)
+        
+        step = audio_data.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            audio_data,
+            shape=(num_frames, self.FRAME_SIZE),
+            strides=(self.FRAME_HOP * step, step),
+            writeable=False
+        )
+    
+    def get_spectrogram(self, frames):
+        """Compute windowed magnitude spectra for a 2-D block of frames"""
+        windowed = frames * self.get_window(frames.shape[1])
+        spectrum = np.abs(rfft(windowed, axis=1))
+        # Keep the same bins as get_fft (drop the Nyquist bin)
+        return spectrum[:, :frames.shape[1] // 2]
+    
     def get_index(self, freq):
         """Get frequency range index"""
         for i, range_freq in enumerate(self.RANGES):
@@ -150,69 +583,265 @@ class AudioAnalyzer:
     
     def find_peaks(self, fft_data, min_freq=40, max_freq=2000):
         """Find spectral peaks in the FFT data"""
-        peaks = {}
+        _, range_idx, freqs, mags = self.find_peaks_matrix(
+            np.asarray(fft_data)[np.newaxis, :], min_freq, max_freq
+        )
+        return {int(r): (f, m) for r, f, m in zip(range_idx, freqs, mags)}
+    
+    def find_peaks_matrix(self, spectrogram, min_freq=40, max_freq=2000):
+        """Find the strongest spectral peak per frequency range for every frame
+        
+        Works on a 2-D frames x bins spectrogram and returns parallel arrays
+        (frame_idx, range_idx, freqs, mags), ordered by frame and then by
+        frequency range. Frames or ranges without a peak are omitted.
+        """
+        num_frames, num_bins = spectrogram.shape
         
         # Convert frequency to FFT bin
-        freq_to_bin = lambda f: int(f * len(fft_data) * 2 / self.RATE)
+        min_bin = int(min_freq * num_bins * 2 / self.ANALYSIS_RATE)
+        max_bin = min(int(max_freq * num_bins * 2 / self.ANALYSIS_RATE), num_bins - 1)
+        lo, hi = min_bin + 1, max_bin - 1
+        if num_frames == 0 or hi <= lo:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty, np.empty(0), np.empty(0)
         
-        min_bin = freq_to_bin(min_freq)
-        max_bin = min(freq_to_bin(max_freq), len(fft_data) - 1)
+        # Local maxima above twice the frame's mean magnitude. A decimated
+        # spectrum has DECIMATION times fewer bins and smaller magnitudes, so
+        # its mean is rescaled to the full-band mean. Energy above the
+        # analysis Nyquist frequency is filtered out and missing from that
+        # mean, so broadband audio gets a lower threshold and more peaks.
+        center = spectrogram[:, lo:hi]
+        threshold = spectrogram.mean(axis=1, keepdims=True) * 2 / self.DECIMATION
+        is_peak = ((center > spectrogram[:, lo - 1:hi - 1]) &
+                   (center > spectrogram[:, lo + 1:hi + 1]) &
+                   (center > threshold))
         
-        # Find local maxima
-        for i in range(min_bin + 1, max_bin - 1):
-            if (fft_data[i] > fft_data[i-1] and 
-                fft_data[i] > fft_data[i+1] and 
-                fft_data[i] > np.mean(fft_data) * 2):  # Threshold
-                
-                freq = i * self.RATE / (2 * len(fft_data))
-                range_idx = self.get_index(freq)
-                
-                if range_idx not in peaks or fft_data[i] > peaks[range_idx][1]:
-                    peaks[range_idx] = (freq, fft_data[i])
+        # Bucket candidate bins into RANGES (same rule as get_index)
+        bin_freqs = np.arange(lo, hi) * self.ANALYSIS_RATE / (2 * num_bins)
+        bin_ranges = np.minimum(
+            np.searchsorted(self.RANGES, bin_freqs, side='right'),
+            len(self.RANGES) - 1
+        )
+        starts = np.flatnonzero(np.r_[True, bin_ranges[1:] != bin_ranges[:-1]])
+        
+        # Strongest peak per range; magnitudes are non-negative so -1 marks "no peak"
+        masked = np.where(is_peak, center, -1.0)
+        range_max = np.maximum.reduceat(masked, starts, axis=1)
+        
+        # First bin reaching the maximum, matching the strict ">" of the original loop
+        seg_lengths = np.diff(np.r_[starts, hi - lo])
+        is_max = is_peak & (masked == np.repeat(range_max, seg_lengths, axis=1))
+        columns = np.where(is_max, np.arange(hi - lo), hi - lo)
+        best_col = np.minimum.reduceat(columns, starts, axis=1)
         
-        return peaks
+        frame_idx, seg_idx = np.nonzero(range_max >= 0)
+        cols = best_col[frame_idx, seg_idx]
+        return (frame_idx, bin_ranges[starts[seg_idx]],
+                bin_freqs[cols], center[frame_idx, cols])
     
     def generate_fingerprint(self, audio_data):
         """Generate audio fingerprints using constellation mapping"""
-        num_chunks = len(audio_data) // self.CHUNK_SIZE
-        fingerprints = []
+        if self.engine == "chunked":
+            return self._generate_fingerprint_chunked(audio_data)
         
-        print(f"Generating fingerprints from {num_chunks} chunks...")
+        num_chunks = self.count_frames(len(audio_data) // self.DECIMATION)
+        if self.verbose:
+            print(f"Generating fingerprints from {num_chunks} chunks...")
+        
+        fingerprints = self.generate_fingerprint_stream([audio_data])
+        if self.verbose:
+            print(f"Generated {len(fingerprints)} fingerprints")
+        return fingerprints
+    
+    def generate_fingerprint_stream(self, blocks):
+        """Generate fingerprints from an iterable of audio sample blocks
+        
+        Only one block and a small amount of carry-over are held in memory
+        at a time, so this works on inputs of any length.
+        """
+        hashes, offsets = [], []
+        for block_hashes, block_offsets in self.iter_fingerprints(blocks):
+            hashes.append(block_hashes)
+            offsets.append(block_offsets)
+        
+        return list(zip(np.concatenate(hashes).tolist(), np.concatenate(offsets).tolist()))
+    
+    def iter_fingerprints(self, blocks):
+        """Yield (hashes, offsets) arrays as blocks of audio samples are consumed"""
+        stream = FingerprintStream(self)
+        for block in blocks:
+            yield stream.feed(block)
+        yield stream.flush()
+    
+    def _generate_fingerprint_chunked(self, audio_data):
+        """Original chunk-by-chunk fingerprinting loop"""
+        audio_data = self.decimate_audio(audio_data)
+        num_chunks = self.count_frames(len(audio_data))
+        frame_idx, freqs, mags = [], [], []
+        
+        if self.verbose:
+            print(f"Generating fingerprints from {num_chunks} chunks...")
         
         for i in range(num_chunks):
-            start = i * self.CHUNK_SIZE
-            end = start + self.CHUNK_SIZE
+            start = i * self.FRAME_HOP
+            end = start + self.FRAME_SIZE
             chunk = audio_data[start:end]
             
-            if len(chunk) < self.CHUNK_SIZE:
+            if len(chunk) < self.FRAME_SIZE:
                 continue
                 
             fft_data = self.get_fft(chunk)
             peaks = self.find_peaks(fft_data)
             
-            if len(peaks) >= 2:
-                # Create constellation pairs
-                peak_freqs = sorted([freq for freq, mag in peaks.values()])
-                
-                # Generate hash pairs
-                for j in range(len(peak_freqs) - 1):
-                    freq1 = peak_freqs[j]
-                    freq2 = peak_freqs[j + 1]
-                    
-                    # Create hash from frequency pair and time offset
-                    h = self.hash_constellation(freq1, freq2, i)
-                    time_offset = i * (self.CHUNK_SIZE / self.RATE)
-                    fingerprints.append((h, time_offset))
+            # Collect the constellation points of this chunk in frequency order
+            for freq, mag in sorted(peaks.values()):
+                frame_idx.append(i)
+                freqs.append(freq)
+                mags.append(mag)
             
-            if i % 100 == 0:
+            if self.verbose and i % 100 == 0:
                 progress = i / num_chunks * 100
                 print(f"Progress: {progress:.1f}%", end='\r')
         
-        print(f"\nGenerated {len(fingerprints)} fingerprints")
+        frame_idx = np.array(frame_idx, dtype=np.intp)
+        freqs = np.array(freqs)
+        anchors, targets = self.pair_peaks(frame_idx, freqs, np.array(mags))
+        hashes, offsets = self.hash_peak_pairs(frame_idx, freqs, anchors, targets)
+        fingerprints = list(zip(hashes.tolist(), offsets.tolist()))
+        if self.verbose:
+            print(f"\nGenerated {len(fingerprints)} fingerprints")
         return fingerprints
     
+    def find_frame_peaks(self, frames, first_frame=0):
+        """Find constellation points in a 2-D block of frames
+        
+        Returns (frame_idx, freqs, mags) arrays ordered by frame and by
+        frequency within each frame. Frame indices start at first_frame.
+        """
+        peaks = [(np.empty(0, dtype=np.intp), np.empty(0), np.empty(0))]
+        for batch_start in range(0, len(frames), self.FRAME_BATCH):
+            spectrogram = self.get_spectrogram(frames[batch_start:batch_start + self.FRAME_BATCH])
+            frame_idx, _, freqs, mags = self.find_peaks_matrix(spectrogram)
+            peaks.append((frame_idx + (first_frame + batch_start), freqs, mags))
+        
+        frame_idx, freqs, mags = (np.concatenate(column) for column in zip(*peaks))
+        return frame_idx, freqs, mags
+    
+    def pair_peaks(self, frame_idx, freqs, mags, num_anchors=None):
+        """Pair constellation points for hashing
+        
+        Peaks must be ordered by frame and by frequency within each frame.
+        Only the first num_anchors peaks are used as anchors (all by
+        default). Returns (anchor, target) index arrays into the peak arrays.
+        """
+        if self.pairing == "target_zone":
+            return self._pair_target_zone(frame_idx, freqs, mags, num_anchors)
+        
+        # Neighbouring peaks within the same frame
+        anchors = np.flatnonzero(frame_idx[1:] == frame_idx[:-1])
+        if num_anchors is not None:
+            anchors = anchors[anchors < num_anchors]
+        return anchors, anchors + 1
+    
+    def hash_peak_pairs(self, frame_idx, freqs, anchors, targets):
+        """Hash paired constellation points into (hashes, offsets) arrays"""
+        anchor_frames = frame_idx[anchors]
+        hashes = self.hash_pairs(
+            freqs[anchors], freqs[targets],
+            self._pair_time(anchor_frames, frame_idx[targets])
+        )
+        return hashes, self.frame_offsets(anchor_frames)
+    
+    def frame_offsets(self, frame_idx):
+        """Convert frame indices to stored offsets in the configured unit"""
+        return frame_idx
+    
+    def get_offset_duration(self):
+        """Get the length in seconds of one unit of stored offset"""
+        return self.HOP_SIZE / self.RATE
+    
+    def _pair_target_zone(self, frame_idx, freqs, mags, num_anchors=None):
+        """Pair each anchor peak with the strongest peaks in its target zone
+        
+        The target zone spans target_zone_frames frames starting
+        target_zone_start frames after the anchor, limited to peaks within
+        target_zone_freq Hz of it. Each anchor is paired with up to fan_value
+        of the strongest peaks in its zone.
+        """
+        if num_anchors is None:
+            num_anchors = len(frame_idx)
+        anchor_frames = frame_idx[:num_anchors]
+        zone_lo = np.searchsorted(frame_idx, anchor_frames + self.target_zone_start, side='left')
+        zone_hi = np.searchsorted(
+            frame_idx, anchor_frames + self.target_zone_start + self.target_zone_frames, side='left'
+        )
+        anchors, targets = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+        
+        for start in range(0, num_anchors, self.PAIR_BATCH):
+            lo = zone_lo[start:start + self.PAIR_BATCH]
+            hi = zone_hi[start:start + self.PAIR_BATCH]
+            width = int((hi - lo).max())
+            if width == 0:
+                continue
+            
+            # Candidate targets for every anchor in this batch, one row each
+            candidates = lo[:, np.newaxis] + np.arange(width)
+            valid = candidates < hi[:, np.newaxis]
+            candidates = np.minimum(candidates, len(frame_idx) - 1)
+            anchor_freqs = freqs[start:start + len(lo), np.newaxis]
+            valid &= np.abs(freqs[candidates] - anchor_freqs) <= self.target_zone_freq
+            
+            # Keep the fan_value strongest candidates per anchor
+            fan = min(self.fan_value, width)
+            strength = np.where(valid, mags[candidates], -1.0)
+            if fan < width:
+                best = np.argpartition(-strength, fan - 1, axis=1)[:, :fan]
+                candidates = np.take_along_axis(candidates, best, axis=1)
+                valid = np.take_along_axis(valid, best, axis=1)
+            else:
+                candidates, valid = candidates[:, :fan], valid[:, :fan]
+            
+            rows = np.broadcast_to(np.arange(start, start + len(lo))[:, np.newaxis], valid.shape)
+            anchors.append(rows[valid])
+            targets.append(candidates[valid])
+        
+        return np.concatenate(anchors), np.concatenate(targets)
+    
+    def _pair_time(self, anchor_frame, target_frame):
+        """Time component hashed for a peak pair under the current scheme"""
+        if self.fingerprint_version == 1:
+            return anchor_frame
+        return target_frame - anchor_frame
+    
+    def hash_pairs(self, freq1, freq2, time_delta):
+        """Hash arrays of peak pairs, returning an int64 array of keys"""
+        if self.fingerprint_version >= 3:
+            return self._pack_hashes(freq1, freq2, time_delta)
+        
+        return np.array([
+            self.hash_constellation(f1, f2, dt)
+            for f1, f2, dt in zip(freq1, freq2, np.asarray(time_delta).tolist())
+        ], dtype=np.int64)
+    
+    def _pack_hashes(self, freq1, freq2, time_delta):
+        """Bit-pack quantized frequencies and time delta into integer keys"""
+        freq_max = (1 << self.HASH_FREQ_BITS) - 1
+        delta_max = (1 << self.HASH_DELTA_BITS) - 1
+        
+        # Quantize frequencies to FUZ_FACTOR Hz steps to reduce noise sensitivity
+        freq1_q = np.minimum((np.asarray(freq1) / self.FUZ_FACTOR).astype(np.int64), freq_max)
+        freq2_q = np.minimum((np.asarray(freq2) / self.FUZ_FACTOR).astype(np.int64), freq_max)
+        delta = np.clip(np.asarray(time_delta, dtype=np.int64), 0, delta_max)
+        
+        return ((freq1_q << (self.HASH_FREQ_BITS + self.HASH_DELTA_BITS)) |
+                (freq2_q << self.HASH_DELTA_BITS) |
+                delta)
+    
     def hash_constellation(self, freq1, freq2, time_delta):
         """Create hash from constellation points"""
+        if self.fingerprint_version >= 3:
+            return int(self._pack_hashes(freq1, freq2, time_delta))
+        
         # Quantize frequencies to reduce noise sensitivity
         freq1_q = int(freq1 / self.FUZ_FACTOR) * self.FUZ_FACTOR
         freq2_q = int(freq2 / self.FUZ_FACTOR) * self.FUZ_FACTOR
@@ -221,14 +850,136 @@ class AudioAnalyzer:
         hash_string = f"{freq1_q}|{freq2_q}|{time_delta}"
         return int(hashlib.md5(hash_string.encode()).hexdigest()[:8], 16)
 
+class FingerprintStream:
+    """Incrementally fingerprint audio that arrives in blocks of samples
+    
+    Only the decimation filter history, the samples needed to complete the
+    next overlapping frame and the peaks whose target zone is still open are
+    kept between blocks, so memory stays bounded however long the stream
+    is. The fingerprints are the same as for the whole signal at once.
+    """
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.num_samples = 0
+        self.num_frames = 0
+        # Decimator input, starting 4 analysis samples before the next output
+        self._history = np.zeros(4 * analyzer.DECIMATION)
+        self._num_decimated = 0
+        # Analysis-rate samples not yet covered by a complete frame
+        self._buffer = None
+        # Peaks that have not been used as anchors yet
+        self._peaks = (np.empty(0, dtype=np.intp), np.empty(0), np.empty(0))
+    
+    def feed(self, samples):
+        """Consume a block of samples, returning the (hashes, offsets) it completes"""
+        samples = np.asarray(samples)
+        self.num_samples += len(samples)
+        self._analyze(self._decimate(samples))
+        return self._emit(final=False)
+    
+    def flush(self):
+        """Finish the stream, returning the remaining (hashes, offsets)"""
+        self._analyze(self._decimate(None))
+        return self._emit(final=True)
+    
+    def _decimate(self, samples):
+        """Decimate a block, keeping filter history across blocks"""
+        factor = self.analyzer.DECIMATION
+        if factor == 1:
+            return samples
+        
+        if samples is None:
+            # Zero-pad the tail, producing as many samples as decimate_audio
+            padded = np.concatenate([self._history, np.zeros(8 * factor)])
+            count = self.num_samples // factor - self._num_decimated
+        else:
+            padded = np.concatenate([self._history, samples])
+            # Outputs whose filter support is fully available
+            count = (len(padded) - 1) // factor - 7
+        if count <= 0:
+            self._history = padded
+            return None
+        
+        filtered = upfirdn(self.analyzer.get_decimation_taps(),
+                           padded[:(count + 7) * factor + 1], down=factor)
+        self._history = padded[count * factor:]
+        self._num_decimated += count
+        return filtered[8:8 + count]
+    
+    def _analyze(self, samples):
+        """Find the peaks of every frame completed by the new samples"""
+        if samples is not None and len(samples):
+            if self._buffer is None or not len(self._buffer):
+                self._buffer = samples
+            else:
+                self._buffer = np.concatenate([self._buffer, samples])
+        if self._buffer is None:
+            return
+        
+        analyzer = self.analyzer
+        frames = analyzer.frame_audio(self._buffer)
+        if not len(frames):
+            return
+        
+        peaks = analyzer.find_frame_peaks(frames, self.num_frames)
+        self._peaks = tuple(np.concatenate(pair) for pair in zip(self._peaks, peaks))
+        self.num_frames += len(frames)
+        self._buffer = self._buffer[len(frames) * analyzer.FRAME_HOP:]
+    
+    def _emit(self, final):
+        """Pair and hash the anchors whose target zone is complete"""
+        analyzer = self.analyzer
+        frame_idx, freqs, mags = self._peaks
+        if final or analyzer.pairing != "target_zone":
+            ready = len(frame_idx)
+        else:
+            last_anchor = (self.num_frames - analyzer.target_zone_start -
+                           analyzer.target_zone_frames)
+            ready = int(np.searchsorted(frame_idx, last_anchor, side='right'))
+        
+        anchors, targets = analyzer.pair_peaks(frame_idx, freqs, mags, ready)
+        hashes, offsets = analyzer.hash_peak_pairs(frame_idx, freqs, anchors, targets)
+        self._peaks = tuple(column[ready:] for column in self._peaks)
+        return hashes, offsets
+
 class Database:
-    def __init__(self, db_file="songs.db"):
+    # Lookup strategies for find_matches: "temp_table" bulk-loads the query
+    # hashes into a temporary table and joins it against the hash index,
+    # "chunked" runs IN (...) queries of at most LOOKUP_CHUNK hashes each
+    LOOKUP_MODES = ("temp_table", "chunked")
+    LOOKUP_CHUNK = 500
+    # Schema versions (stored in PRAGMA user_version): 1 is the original
+    # rowid fingerprints table with REAL offsets and separate hash and
+    # song_id indexes, 2 clusters fingerprints on (hash, song_id, offset)
+    # in a WITHOUT ROWID table with integer frame offsets, 3 adds the
+    # hash_counts table of posting list lengths
+    SCHEMA_VERSION = 3
+    # Number of songs whose metadata get_song_info keeps in memory
+    SONG_CACHE_SIZE = 1024
+    
+    def __init__(self, db_file="songs.db", lookup="temp_table", max_hash_postings=None,
+                 verbose=True, read_only=False):
+        if lookup not in self.LOOKUP_MODES:
+            raise ValueError(f"Unknown lookup mode: {lookup}")
+        
         self.db_file = db_file
+        self.lookup = lookup
+        # Hashes stored more often than this are skipped at query time
+        self.max_hash_postings = max_hash_postings
+        # Progress messages are printed only when verbose
+        self.verbose = verbose
+        # Read-only databases open an existing file and never write to it
+        self.read_only = read_only
         self.conn = None
         self.cursor = None
+        self._song_cache = OrderedDict()
         
     def connect(self):
-        self.conn = sqlite3.connect(self.db_file)
+        if self.read_only:
+            uri = f"file:{urllib.parse.quote(os.path.abspath(self.db_file))}?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True)
+        else:
+            self.conn = sqlite3.connect(self.db_file)
         self.cursor = self.conn.cursor()
         
     def close(self):
@@ -238,6 +989,10 @@ class Database:
     def initialize(self):
         """Initialize database with improved schema"""
         self.connect()
+        if self.read_only:
+            # The schema is created and migrated by writers only
+            return
+        
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS songs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -251,28 +1006,189 @@ class Database:
             )
         ''')
         
+        # Key/value settings describing how this database was fingerprinted
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        ''')
+        
+        self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fingerprints'"
+        )
+        if self.cursor.fetchone() is None:
+            self._create_fingerprints_table()
+            self._create_hash_counts_table()
+            self.cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        else:
+            # Databases created in seconds after schema 2 are converted too
+            if (self.get_schema_version() < 2
+                    or self.get_metadata('offset_unit') == 'seconds'):
+                self._migrate_to_clustered_fingerprints()
+            if self.get_schema_version() < 3:
+                self._migrate_to_hash_counts()
+        
+        # Tells databases apart, as their revisions all count up from 0
+        if self.get_metadata('database_id') is None:
+            self.set_metadata('database_id', uuid.uuid4().hex, commit=False)
+        self.conn.commit()
+    
+    def enable_wal(self):
+        """Switch the database file to write-ahead logging
+        
+        Readers then keep working while a writer commits. The setting is
+        stored in the file, so it only needs to be enabled once.
+        """
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        return self.cursor.fetchone()[0] == 'wal'
+    
+    def get_schema_version(self):
+        """Get the schema version of the database file"""
+        self.cursor.execute('PRAGMA user_version')
+        return self.cursor.fetchone()[0] or 1
+    
+    def _create_fingerprints_table(self):
+        """Create the fingerprints table
+        
+        Rows are clustered on (hash, song_id, offset), so a lookup by hash is
+        a range scan of the table itself and no secondary index is needed.
+        Offsets are integer frame indices.
+        """
         self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS fingerprints (
+            CREATE TABLE fingerprints (
                 hash INTEGER NOT NULL,
                 song_id INTEGER NOT NULL,
-                offset REAL NOT NULL,
+                offset INTEGER NOT NULL,
+                PRIMARY KEY (hash, song_id, offset),
                 FOREIGN KEY (song_id) REFERENCES songs (id) ON DELETE CASCADE
-            )
+            ) WITHOUT ROWID
         ''')
-        
-        # Create indexes for better performance
+    
+    def _create_hash_counts_table(self):
+        """Create the table of fingerprint rows per hash"""
         self.cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_fingerprints_hash ON fingerprints (hash)
+            CREATE TABLE hash_counts (
+                hash INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL
+            ) WITHOUT ROWID
         ''')
-        
+    
+    def _migrate_to_hash_counts(self):
+        """Add the hash_counts table of schema 3 to a schema 2 database"""
+        self.conn.commit()
+        self.cursor.execute('BEGIN')
+        # Rebuilt from scratch after the fingerprints table is
+        self.cursor.execute('DROP TABLE IF EXISTS hash_counts')
+        self._create_hash_counts_table()
         self.cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_fingerprints_song ON fingerprints (song_id)
+            INSERT INTO hash_counts (hash, count)
+            SELECT hash, COUNT(*) FROM fingerprints GROUP BY hash
         ''')
+        self.cursor.execute('PRAGMA user_version = 3')
+        self.conn.commit()
+    
+    def _migrate_to_clustered_fingerprints(self):
+        """Rebuild a fingerprints table in the schema 2 layout
+        
+        Offsets stored in seconds are converted to frame indices using the
+        database's recorded hop size and sample rate.
+        """
+        print(f"Migrating fingerprints in {self.db_file} to the compact layout...")
+        config = dict(AudioAnalyzer.LEGACY_CONFIG, **(self.get_fingerprint_config() or {}))
+        if config['offset_unit'] == 'seconds':
+            scale = config['rate'] / config['hop_size']
+        else:
+            scale = 1
+        
+        self.conn.commit()
+        self.cursor.execute('BEGIN')
+        self.cursor.execute('ALTER TABLE fingerprints RENAME TO fingerprints_v1')
+        self._create_fingerprints_table()
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO fingerprints (hash, song_id, offset)
+            SELECT hash, song_id, CAST(ROUND(offset * ?) AS INTEGER)
+            FROM fingerprints_v1
+            ORDER BY 1, 2, 3
+        ''', (scale,))
+        # Dropping the old table also drops its two secondary indexes
+        self.cursor.execute('DROP TABLE fingerprints_v1')
+        self.set_metadata('offset_unit', 'frames', commit=False)
+        self.cursor.execute('PRAGMA user_version = 2')
+        self.conn.commit()
+        
+        # Return the space used by the old table and indexes to the filesystem
+        self.cursor.execute('VACUUM')
+    
+    def get_metadata(self, key, default=None):
+        """Get a database setting"""
+        self.cursor.execute('SELECT value FROM metadata WHERE key = ?', (key,))
+        row = self.cursor.fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def set_metadata(self, key, value, commit=True):
+        """Store a database setting"""
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)
+        ''', (key, json.dumps(value)))
+        if commit:
+            self.conn.commit()
+    
+    def get_fingerprint_version(self):
+        """Get the fingerprint scheme used by this database
+        
+        Databases created before schemes were versioned hold version 1
+        fingerprints. Returns None for a new, empty database.
+        """
+        version = self.get_metadata('fingerprint_version')
+        if version is not None:
+            return int(version)
+        
+        self.cursor.execute('SELECT 1 FROM songs LIMIT 1')
+        return 1 if self.cursor.fetchone() else None
+    
+    def get_fingerprint_config(self):
+        """Get the recorded fingerprint settings, or None for a new database
+        
+        Settings that were never recorded are left out; callers fill them in
+        with their pre-configurable defaults.
+        """
+        version = self.get_fingerprint_version()
+        if version is None:
+            return None
         
+        self.cursor.execute('SELECT key, value FROM metadata')
+        config = {key: json.loads(value) for key, value in self.cursor.fetchall()
+                  if key in AudioAnalyzer.CONFIG_KEYS}
+        config['fingerprint_version'] = version
+        return config
+    
+    def get_revision(self):
+        """Get the content revision, which changes whenever songs are added or deleted"""
+        return self.get_metadata('revision', 0)
+    
+    def get_database_id(self):
+        """Get the random id given to this database when it was created"""
+        return self.get_metadata('database_id')
+    
+    def _bump_revision(self):
+        self.cursor.execute('''
+            INSERT INTO metadata (key, value) VALUES ('revision', '1')
+            ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        ''')
+    
+    def save_fingerprint_config(self, config):
+        """Record the fingerprint settings used by this database"""
+        for key, value in config.items():
+            self.set_metadata(key, value, commit=False)
         self.conn.commit()
         
-    def add_song(self, name, artist, file_path, fingerprints, album=None, duration=None):
-        """Add song with improved metadata"""
+    def add_song(self, name, artist, file_path, fingerprints, album=None, duration=None,
+                 commit=True):
+        """Add song with improved metadata
+        
+        Bulk loaders pass commit=False to add many songs per transaction.
+        """
         date_added = datetime.now().isoformat()
         
         self.cursor.execute('''
@@ -286,41 +1202,172 @@ class Database:
         batch_size = 1000
         for i in range(0, len(fingerprints), batch_size):
             batch = fingerprints[i:i + batch_size]
+            # Identical (hash, offset) pairs within a song are stored once
             self.cursor.executemany('''
-                INSERT INTO fingerprints (hash, song_id, offset)
+                INSERT OR IGNORE INTO fingerprints (hash, song_id, offset)
                 VALUES (?, ?, ?)
             ''', [(h, song_id, offset) for h, offset in batch])
         
-        self.conn.commit()
-        print(f"Added song '{name}' by {artist} with {len(fingerprints)} fingerprints")
+        # Count only the rows that were stored, after duplicates were ignored
+        postings = defaultdict(int)
+        for h, _ in {(int(h), offset) for h, offset in fingerprints}:
+            postings[h] += 1
+        self.cursor.executemany('''
+            INSERT INTO hash_counts (hash, count) VALUES (?, ?)
+            ON CONFLICT (hash) DO UPDATE SET count = count + excluded.count
+        ''', postings.items())
+        self._bump_revision()
+        
+        if commit:
+            self.conn.commit()
+        if self.verbose:
+            print(f"Added song '{name}' by {artist} with {len(fingerprints)} fingerprints")
         return song_id
     
     def find_matches(self, fingerprints):
-        """Find matching fingerprints with improved querying"""
+        """Find matching fingerprints as (hash, song_id, offset) rows
+        
+        Song metadata is left out of the hot query; use get_song_info for
+        the songs that actually win.
+        """
         if not fingerprints:
             return []
-            
-        hashes = [str(f[0]) for f in fingerprints]
         
-        # Use parameterized query for safety
-        placeholders = ','.join(['?'] * len(hashes))
-        query = f'''
-            SELECT f.hash, f.song_id, f.offset, s.name, s.artist
-            FROM fingerprints f
-            JOIN songs s ON f.song_id = s.id
-            WHERE f.hash IN ({placeholders})
-        '''
+        # Each distinct hash is looked up once, as an integer like the column
+        hashes = sorted({int(f[0]) for f in fingerprints})
         
-        self.cursor.execute(query, hashes)
-        return self.cursor.fetchall()
+        if self.lookup == "chunked":
+            return self._find_matches_chunked(hashes)
+        return self._find_matches_temp_table(hashes)
+    
+    def find_match_arrays(self, hashes):
+        """Find the rows of the given query hashes as (hashes, song_ids, offsets) arrays"""
+        rows = self.find_matches([(h, 0) for h in np.unique(np.asarray(hashes, dtype=np.int64)).tolist()])
+        if not rows:
+            return (np.empty(0, dtype=np.int64),) * 3
+        
+        return tuple(np.array(column) for column in zip(*rows))
+    
+    def _find_matches_temp_table(self, hashes):
+        """Join the fingerprints table against a temporary table of query hashes
+        
+        Avoids SQLite's limit on bound variables, and the CROSS JOIN makes
+        SQLite probe the fingerprints primary key once per query hash. With
+        max_hash_postings set, hash_counts is probed first so stop hashes
+        never reach the fingerprints table.
+        """
+        self.cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS query_hashes (hash INTEGER PRIMARY KEY)
+        ''')
+        self.cursor.execute('DELETE FROM query_hashes')
+        self.cursor.executemany('INSERT INTO query_hashes (hash) VALUES (?)',
+                                ((h,) for h in hashes))
+        
+        if self.max_hash_postings is None:
+            self.cursor.execute('''
+                SELECT f.hash, f.song_id, f.offset
+                FROM query_hashes q
+                CROSS JOIN fingerprints f ON f.hash = q.hash
+            ''')
+        else:
+            self.cursor.execute('''
+                SELECT f.hash, f.song_id, f.offset
+                FROM query_hashes q
+                CROSS JOIN hash_counts c ON c.hash = q.hash
+                CROSS JOIN fingerprints f ON f.hash = q.hash
+                WHERE c.count <= ?
+            ''', (self.max_hash_postings,))
+        matches = self.cursor.fetchall()
+        
+        self.cursor.execute('DELETE FROM query_hashes')
+        self.conn.commit()
+        return matches
+    
+    def _find_matches_chunked(self, hashes):
+        """Look up hashes with IN (...) queries of at most LOOKUP_CHUNK values"""
+        matches = []
+        for i in range(0, len(hashes), self.LOOKUP_CHUNK):
+            chunk = hashes[i:i + self.LOOKUP_CHUNK]
+            
+            # Use parameterized query for safety
+            placeholders = ','.join(['?'] * len(chunk))
+            if self.max_hash_postings is None:
+                self.cursor.execute(f'''
+                    SELECT hash, song_id, offset
+                    FROM fingerprints
+                    WHERE hash IN ({placeholders})
+                ''', chunk)
+            else:
+                self.cursor.execute(f'''
+                    SELECT f.hash, f.song_id, f.offset
+                    FROM hash_counts c
+                    CROSS JOIN fingerprints f ON f.hash = c.hash
+                    WHERE c.hash IN ({placeholders}) AND c.count <= ?
+                ''', chunk + [self.max_hash_postings])
+            matches.extend(self.cursor.fetchall())
+        return matches
     
     def get_song_info(self, song_id):
-        """Get detailed song information"""
+        """Get detailed song information, through a small LRU cache"""
+        info = self._song_cache.get(song_id)
+        if info is not None:
+            self._song_cache.move_to_end(song_id)
+            return info
+        
         self.cursor.execute('''
             SELECT name, artist, album, duration, date_added, fingerprint_count
             FROM songs WHERE id = ?
         ''', (song_id,))
-        return self.cursor.fetchone()
+        info = self.cursor.fetchone()
+        if info is not None:
+            self._song_cache[song_id] = info
+            if len(self._song_cache) > self.SONG_CACHE_SIZE:
+                self._song_cache.popitem(last=False)
+        return info
+    
+    def create_analyzer(self, **options):
+        """Create the analyzer with the fingerprint settings of the database
+        
+        New databases record the settings they are created with; existing
+        ones always use their recorded settings.
+        """
+        stored = self.get_fingerprint_config()
+        if stored is None:
+            analyzer = AudioAnalyzer(**options)
+            if not self.read_only:
+                self.save_fingerprint_config(analyzer.get_config())
+            return analyzer
+        
+        config = dict(AudioAnalyzer.LEGACY_CONFIG, **stored)
+        conflicts = sorted(key for key, value in options.items()
+                           if key in config and config[key] != value)
+        if conflicts:
+            raise ValueError(
+                f"Database {self.db_file} was created with different "
+                f"fingerprint settings: {', '.join(conflicts)}"
+            )
+        
+        analyzer = AudioAnalyzer(**dict(options, **config))
+        if stored.keys() != config.keys() and not self.read_only:
+            self.save_fingerprint_config(analyzer.get_config())
+        return analyzer
+    
+    def get_index_metadata(self):
+        """Describe the database contents for checking exported index files"""
+        self.cursor.execute('SELECT COUNT(*), MAX(id) FROM songs')
+        song_count, last_song_id = self.cursor.fetchone()
+        return {
+            'database_id': self.get_database_id(),
+            'fingerprint_config': self.get_fingerprint_config(),
+            'song_count': song_count,
+            'last_song_id': last_song_id,
+        }
+    
+    def export_index(self, filename):
+        """Write all fingerprints to a FingerprintIndex file"""
+        index = FingerprintIndex.from_database(self)
+        index.save(filename)
+        return index
     
     def get_all_songs(self):
         """Get list of all songs in database"""
@@ -331,92 +1378,703 @@ class Database:
         return self.cursor.fetchall()
     
     def delete_song(self, song_id):
-        """Delete a song and its fingerprints"""
+        """Delete a song and its fingerprints
+        
+        Fingerprints are clustered by hash, so this scans the whole table.
+        """
+        self.cursor.execute('''
+            SELECT hash, COUNT(*) FROM fingerprints WHERE song_id = ? GROUP BY hash
+        ''', (song_id,))
+        postings = self.cursor.fetchall()
+        self.cursor.executemany('''
+            UPDATE hash_counts SET count = count - ? WHERE hash = ?
+        ''', [(count, h) for h, count in postings])
+        self.cursor.execute('DELETE FROM hash_counts WHERE count <= 0')
+        self.cursor.execute('DELETE FROM fingerprints WHERE song_id = ?', (song_id,))
         self.cursor.execute('DELETE FROM songs WHERE id = ?', (song_id,))
+        self._bump_revision()
         self.conn.commit()
+        self._song_cache.pop(song_id, None)
+
+class FingerprintIndex:
+    """Sorted (hash, song_id, offset) columns, in memory or mapped from a file
+    
+    Safe to share between threads; lookups never see a partial add or remove.
+    """
+    HASH_DTYPE = np.uint32
+    ID_DTYPE = np.int32
+    OFFSET_DTYPE = np.int32
+    
+    FILE_MAGIC = b"TTFPIDX\0"
+    FILE_VERSION = 1
+    FILE_HEADER = struct.Struct("<8sIQI")
+    FILE_ALIGNMENT = 16
+    
+    def __init__(self, hashes=None, song_ids=None, offsets=None, metadata=None):
+        self.hashes = np.asarray(hashes if hashes is not None else [], dtype=self.HASH_DTYPE)
+        self.song_ids = np.asarray(song_ids if song_ids is not None else [], dtype=self.ID_DTYPE)
+        self.offsets = np.asarray(offsets if offsets is not None else [], dtype=self.OFFSET_DTYPE)
+        # Describes what the index was built from; saved with the file
+        self.metadata = metadata or {}
+        # Database revision the rows reflect, if known
+        self.revision = None
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.hashes)
+    
+    @classmethod
+    def from_database(cls, database):
+        """Load every fingerprint of a database
+        
+        The fingerprints table is clustered on its primary key, so sorting
+        by it costs nothing but makes the order guaranteed.
+        """
+        database.cursor.execute('SELECT COUNT(*) FROM fingerprints')
+        count = database.cursor.fetchone()[0]
+        database.cursor.execute('''
+            SELECT hash, song_id, offset FROM fingerprints ORDER BY hash, song_id, offset
+        ''')
+        rows = np.fromiter(database.cursor, count=count, dtype=[
+            ('hash', cls.HASH_DTYPE), ('song_id', cls.ID_DTYPE), ('offset', cls.OFFSET_DTYPE)
+        ])
+        return cls(rows['hash'], rows['song_id'], rows['offset'],
+                   metadata=database.get_index_metadata())
+    
+    def save(self, filename):
+        """Write the index to a file, replacing it atomically"""
+        metadata = json.dumps(self.metadata, sort_keys=True).encode()
+        header = self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION,
+                                       len(self), len(metadata))
+        padding = -(len(header) + len(metadata)) % self.FILE_ALIGNMENT
+        
+        temp_file = f"{filename}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(header)
+            f.write(metadata)
+            f.write(b"\0" * padding)
+            self.hashes.astype('<u4').tofile(f)
+            self.song_ids.astype('<i4').tofile(f)
+            self.offsets.astype('<i4').tofile(f)
+        os.replace(temp_file, filename)
+    
+    @classmethod
+    def read_header(cls, filename):
+        """Read the row count, metadata and column offset of an index file"""
+        with open(filename, 'rb') as f:
+            header = f.read(cls.FILE_HEADER.size)
+            if len(header) < cls.FILE_HEADER.size:
+                raise ValueError(f"{filename} is not a fingerprint index file")
+            magic, version, count, metadata_size = cls.FILE_HEADER.unpack(header)
+            if magic != cls.FILE_MAGIC:
+                raise ValueError(f"{filename} is not a fingerprint index file")
+            if version != cls.FILE_VERSION:
+                raise ValueError(f"Unsupported fingerprint index version: {version}")
+            metadata = json.loads(f.read(metadata_size))
+        
+        data_offset = cls.FILE_HEADER.size + metadata_size
+        data_offset += -data_offset % cls.FILE_ALIGNMENT
+        return count, metadata, data_offset
+    
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """Load an index file, memory-mapping its columns by default"""
+        count, metadata, offset = cls.read_header(filename)
+        
+        columns = []
+        for dtype in ('<u4', '<i4', '<i4'):
+            if count == 0:
+                columns.append(np.empty(0, dtype=dtype))
+            elif mmap:
+                columns.append(np.memmap(filename, dtype=dtype, mode='r',
+                                         offset=offset, shape=(count,)))
+            else:
+                columns.append(np.fromfile(filename, dtype=dtype, count=count, offset=offset))
+            offset += count * 4
+        return cls(*columns, metadata=metadata)
+    
+    def add(self, song_id, fingerprints, revision=None):
+        """Merge the (hash, offset) fingerprints of a song into the index
+        
+        revision, if given, becomes the index's revision together with the
+        new rows.
+        """
+        if not fingerprints:
+            self._set_columns(self.hashes, self.song_ids, self.offsets, revision)
+            return
+        
+        new = np.array(fingerprints, dtype=np.int64).reshape(-1, 2)
+        order = np.argsort(new[:, 0], kind='stable')
+        hashes = new[order, 0].astype(self.HASH_DTYPE)
+        positions = np.searchsorted(self.hashes, hashes, side='right')
+        
+        self._set_columns(np.insert(self.hashes, positions, hashes),
+                          np.insert(self.song_ids, positions, song_id),
+                          np.insert(self.offsets, positions, new[order, 1].astype(self.OFFSET_DTYPE)),
+                          revision)
+    
+    def remove(self, song_id, revision=None):
+        """Drop every fingerprint of a song"""
+        keep = self.song_ids != song_id
+        self._set_columns(self.hashes[keep], self.song_ids[keep], self.offsets[keep], revision)
+    
+    def _set_columns(self, hashes, song_ids, offsets, revision=None):
+        with self._lock:
+            self.hashes, self.song_ids, self.offsets = hashes, song_ids, offsets
+            if revision is not None:
+                self.revision = revision
+    
+    def _get_columns(self):
+        with self._lock:
+            return self.hashes, self.song_ids, self.offsets
+    
+    def lookup(self, hashes, max_postings=None):
+        """Find the rows of each distinct query hash
+        
+        Hashes with more than max_postings rows are skipped. Returns
+        (hashes, song_ids, offsets) arrays of the matching rows.
+        """
+        query = np.unique(np.asarray(hashes, dtype=np.int64))
+        query = query[(query >= 0) & (query <= np.iinfo(self.HASH_DTYPE).max)]
+        query = query.astype(self.HASH_DTYPE)
+        index_hashes, index_songs, index_offsets = self._get_columns()
+        
+        starts = np.searchsorted(index_hashes, query, side='left')
+        counts = np.searchsorted(index_hashes, query, side='right') - starts
+        if max_postings is not None:
+            counts[counts > max_postings] = 0
+        
+        # Expand each [start, start + count) range into row indices
+        total = int(counts.sum())
+        run_starts = np.cumsum(counts) - counts
+        rows = np.repeat(starts - run_starts, counts) + np.arange(total)
+        return index_hashes[rows], index_songs[rows], index_offsets[rows]
+
+class InMemoryDatabase(Database):
+    """Database that answers fingerprint lookups from a FingerprintIndex
+    
+    Loads the index from SQLite or a matching index_file, or uses the given
+    index as is.
+    """
+    def __init__(self, db_file="songs.db", lookup="temp_table", index_file=None,
+                 max_hash_postings=None, verbose=True, read_only=False, index=None):
+        super().__init__(db_file, lookup, max_hash_postings, verbose, read_only)
+        self.index_file = index_file
+        self.index = index
+    
+    def initialize(self):
+        super().initialize()
+        if self.index is None:
+            self.index = self._load_index()
+            self.index.revision = super().get_revision()
+    
+    def _load_index(self):
+        if self.index_file and os.path.exists(self.index_file):
+            index = FingerprintIndex.load(self.index_file)
+            if self._index_matches(index.metadata, self.get_index_metadata()):
+                if self.verbose:
+                    print(f"Mapped {len(index)} fingerprints from {self.index_file}")
+                return index
+            print(f"Index file {self.index_file} is out of date, ignoring it")
+        
+        index = FingerprintIndex.from_database(self)
+        if self.verbose:
+            print(f"Loaded {len(index)} fingerprints into memory")
+        return index
+    
+    @staticmethod
+    def _index_matches(saved, current):
+        """Whether an index file was exported from this database as it is now"""
+        # Settings recorded later only fill in their legacy defaults
+        configs = [dict(AudioAnalyzer.LEGACY_CONFIG, **(metadata.get('fingerprint_config') or {}))
+                   for metadata in (saved, current)]
+        return (configs[0] == configs[1] and
+                all(saved.get(key) == current[key]
+                    for key in ('database_id', 'song_count', 'last_song_id')))
+    
+    def get_revision(self):
+        """Get the revision of the index, which may trail the table while a song is added"""
+        return self.index.revision
+    
+    def add_song(self, name, artist, file_path, fingerprints, album=None, duration=None,
+                 commit=True):
+        song_id = super().add_song(name, artist, file_path, fingerprints, album, duration, commit)
+        # Mirror the INSERT OR IGNORE of the table by merging distinct rows only
+        self.index.add(song_id, sorted({(int(h), int(offset)) for h, offset in fingerprints}),
+                       revision=super().get_revision())
+        return song_id
+    
+    def delete_song(self, song_id):
+        super().delete_song(song_id)
+        self.index.remove(song_id, revision=super().get_revision())
+    
+    def find_matches(self, fingerprints):
+        """Find matching fingerprints as (hash, song_id, offset) rows"""
+        if not fingerprints:
+            return []
+        
+        hashes, song_ids, offsets = self.find_match_arrays([f[0] for f in fingerprints])
+        return list(zip(hashes.tolist(), song_ids.tolist(), offsets.tolist()))
+    
+    def find_match_arrays(self, hashes):
+        """Find the rows of the given query hashes as (hashes, song_ids, offsets) arrays"""
+        return self.index.lookup(hashes, self.max_hash_postings)
+
+class MatchAccumulator:
+    """Offset histograms of query matches, accumulated slice by slice
+    
+    Holds one (song, bin, count) entry per song and quantized offset
+    difference seen so far, so a query can be matched in time-ordered
+    slices and scored after each one.
+    """
+    def __init__(self):
+        self.songs = np.empty(0, dtype=np.int64)
+        self.bins = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.query_count = 0
+    
+    def add(self, query_hashes, query_offsets, hashes, song_ids, offsets):
+        """Add the matched rows of a slice of query fingerprints"""
+        self.query_count += len(query_hashes)
+        pair_songs, pair_bins = SongMatcher.align(query_hashes, query_offsets,
+                                                  hashes, song_ids, offsets)
+        if not len(pair_songs):
+            return
+        
+        self.songs, self.bins, self.counts = SongMatcher.histogram(
+            np.concatenate([self.songs, pair_songs]),
+            np.concatenate([self.bins, pair_bins]),
+            np.concatenate([self.counts, np.ones(len(pair_songs), dtype=np.int64)])
+        )
+    
+    def score(self, min_matches=5):
+        """Get (song_ids, aligned, hits, deltas) arrays, see SongMatcher.score"""
+        empty = np.empty(0, dtype=np.int64)
+        if not len(self.songs):
+            return empty, empty, empty, empty.astype(float)
+        
+        group_starts = np.flatnonzero(np.r_[True, self.songs[1:] != self.songs[:-1]])
+        songs = self.songs[group_starts]
+        hits = np.add.reduceat(self.counts, group_starts)
+        
+        # The first entry of each song after ordering by descending count is
+        # its peak bin, the earliest one on ties
+        peaks = np.lexsort((-self.counts, self.songs))[group_starts]
+        aligned = self.counts[peaks]
+        deltas = self.bins[peaks] / 10
+        
+        keep = hits >= min_matches
+        return songs[keep], aligned[keep], hits[keep], deltas[keep]
+    
+    def is_decided(self, min_aligned, margin, min_matches=5):
+        """Whether the best song has min_aligned matches and leads by margin"""
+        _, aligned, _, _ = self.score(min_matches)
+        if not len(aligned):
+            return False
+        
+        top = np.sort(aligned)[-2:]
+        runner_up = top[0] if len(top) > 1 else 0
+        return top[-1] >= min_aligned and top[-1] - runner_up >= margin
 
 class SongMatcher:
-    def __init__(self, database):
+    def __init__(self, database, frame_duration=1.0):
         self.db = database
+        # Seconds per unit of stored offset, for reporting track positions
+        self.frame_duration = frame_duration
         
-    def match(self, query_fingerprints, min_matches=5):
-        """Improved matching algorithm with time alignment"""
-        matches = self.db.find_matches(query_fingerprints)
+    def match(self, query_fingerprints, min_matches=5, top_k=None):
+        """Improved matching algorithm with time alignment
         
-        if not matches:
-            return None
+        Returns the best (name, artist, aligned) match, or with top_k a list
+        of up to top_k candidate dicts, best first.
+        """
+        accumulator = MatchAccumulator()
+        self.add_matches(accumulator, query_fingerprints)
+        return self.result(accumulator, min_matches, top_k)
+    
+    def add_matches(self, accumulator, query_fingerprints):
+        """Look up a slice of query fingerprints and add it to accumulator"""
+        if not len(query_fingerprints):
+            return
         
-        # Group matches by song and calculate time alignment
-        song_matches = defaultdict(list)
-        query_times = {h: t for h, t in query_fingerprints}
+        query = np.asarray(query_fingerprints)
+        self.add_match_arrays(accumulator, query[:, 0].astype(np.int64), query[:, 1])
+    
+    def add_match_arrays(self, accumulator, query_hashes, query_offsets):
+        """Look up query hash and offset arrays and add them to accumulator"""
+        if not len(query_hashes):
+            return
+        accumulator.add(query_hashes, query_offsets, *self.db.find_match_arrays(query_hashes))
+    
+    def result(self, accumulator, min_matches=5, top_k=None):
+        """Get the match, or top_k candidates, from accumulated matches"""
+        song_ids, aligned, hits, deltas = accumulator.score(min_matches)
+        if top_k:
+            return self._rank(song_ids, aligned, hits, deltas, top_k, accumulator.query_count)
         
-        for h, song_id, db_offset, name, artist in matches:
-            if h in query_times:
-                query_offset = query_times[h]
-                time_diff = db_offset - query_offset
-                song_matches[song_id].append((time_diff, name, artist))
+        if not len(song_ids):
+            return None
         
-        # Find best match using time alignment
-        best_song = None
-        best_score = 0
+        # Ties go to the lowest song id
+        best = np.argmax(aligned)
+        best_song_id, best_score = int(song_ids[best]), int(aligned[best])
+        
+        # Only the winner's metadata is needed
+        info = self.db.get_song_info(best_song_id)
+        if info is None:
+            return None
+        name, artist = info[:2]
+        return (name, artist, best_score)
+    
+    def _rank(self, song_ids, aligned, hits, deltas, top_k, query_count):
+        """Describe the top_k scoring songs, best first"""
+        if len(song_ids) > top_k:
+            # Partial sort: only the top_k candidates are ordered
+            top = np.argpartition(-aligned, top_k - 1)[:top_k]
+        else:
+            top = np.arange(len(song_ids))
+        top = top[np.lexsort((song_ids[top], -aligned[top]))]
         
-        for song_id, time_diffs in song_matches.items():
-            if len(time_diffs) < min_matches:
+        candidates = []
+        for i in top.tolist():
+            info = self.db.get_song_info(int(song_ids[i]))
+            if info is None:
                 continue
-                
-            # Find the most common time difference (alignment)
-            time_diff_counts = defaultdict(int)
-            for time_diff, name, artist in time_diffs:
-                # Quantize time differences to handle small variations
-                quantized_diff = round(time_diff * 10) / 10
-                time_diff_counts[quantized_diff] += 1
-            
-            if time_diff_counts:
-                max_aligned_matches = max(time_diff_counts.values())
-                if max_aligned_matches > best_score:
-                    best_score = max_aligned_matches
-                    best_song = (time_diffs[0][1], time_diffs[0][2], max_aligned_matches)
-        
-        return best_song
+            name, artist, album, duration, date_added, fingerprint_count = info
+            candidates.append({
+                'song_id': int(song_ids[i]),
+                'name': name,
+                'artist': artist,
+                'aligned': int(aligned[i]),
+                'hits': int(hits[i]),
+                'query_ratio': int(aligned[i]) / query_count,
+                'song_ratio': int(aligned[i]) / fingerprint_count if fingerprint_count else 0.0,
+                'offset': float(deltas[i]) * self.frame_duration,
+            })
+        return candidates
+    
+    @staticmethod
+    def score(query_hashes, query_offsets, hashes, song_ids, offsets, min_matches=5):
+        """Score matched rows by their most common time difference per song
+        
+        Every query occurrence of a hash is paired with every database row of
+        that hash. The pairs of each song are histogrammed on the offset
+        difference, quantized to tenths like the original matcher, and the
+        peak bin is the song's aligned count. Returns (song_ids, aligned,
+        hits, deltas) arrays for the songs with at least min_matches pairs,
+        sorted by song id, where hits counts all pairs of a song and deltas
+        is the offset difference of its peak bin.
+        """
+        accumulator = MatchAccumulator()
+        accumulator.add(query_hashes, query_offsets, hashes, song_ids, offsets)
+        return accumulator.score(min_matches)
+    
+    @staticmethod
+    def align(query_hashes, query_offsets, hashes, song_ids, offsets):
+        """Pair matched rows with query fingerprints
+        
+        Returns the song id and the offset difference in tenths of each pair.
+        """
+        query_hashes = np.asarray(query_hashes, dtype=np.int64)
+        hashes = np.asarray(hashes, dtype=np.int64)
+        
+        # Pair each database row with every query occurrence of its hash
+        order = np.argsort(query_hashes, kind='stable')
+        sorted_hashes = query_hashes[order]
+        starts = np.searchsorted(sorted_hashes, hashes, side='left')
+        counts = np.searchsorted(sorted_hashes, hashes, side='right') - starts
+        run_starts = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(len(hashes)), counts)
+        query_rows = order[np.repeat(starts - run_starts, counts) + np.arange(len(rows))]
+        
+        pair_songs = np.asarray(song_ids, dtype=np.int64)[rows]
+        deltas = np.asarray(offsets)[rows] - np.asarray(query_offsets)[query_rows]
+        return pair_songs, np.round(deltas * 10).astype(np.int64)
+    
+    @staticmethod
+    def histogram(songs, bins, counts):
+        """Sum counts per (song, bin), returning entries sorted by song and bin"""
+        min_bin = bins.min()
+        span = int(bins.max() - min_bin) + 1
+        keys, inverse = np.unique(songs * span + (bins - min_bin), return_inverse=True)
+        totals = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+        return keys // span, keys % span + min_bin, totals
+
+class ResultCache:
+    """Thread-safe LRU cache of identification results, keyed by audio content
+    
+    Entries expire after ttl seconds or when the database revision changes,
+    and are also kept as JSON files in cache_dir when one is given.
+    """
+    READ_SIZE = 1 << 20
+    
+    def __init__(self, max_entries=1024, ttl=3600, cache_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @classmethod
+    def file_digest(cls, filename):
+        """SHA-256 of a file's contents"""
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(cls.READ_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def key(content_digest, fingerprint_config, database_id, revision, **params):
+        """Build the cache key of a query and the settings that shape its result"""
+        description = json.dumps([content_digest, fingerprint_config, database_id, revision, params],
+                                 sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+    
+    def get(self, key):
+        """Return (found, result) for a key"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, result = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, self._decode(result)
+                del self._entries[key]
+        
+        result = self._read_disk(key, now)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return False, None
+            self.disk_hits += 1
+            self._store(key, result, now)
+        return True, self._decode(result)
+    
+    def put(self, key, result):
+        """Cache the result of a query"""
+        now = time.time()
+        data = self._encode(result)
+        with self._lock:
+            self._store(key, data, now)
+        self._write_disk(key, data)
+    
+    @staticmethod
+    def _encode(result):
+        # Results are None, a (name, artist, confidence) tuple or a list of
+        # candidate dicts; JSON keeps everything but the tuple
+        return json.dumps({'tuple': isinstance(result, tuple), 'result': result}).encode()
+    
+    @staticmethod
+    def _decode(data):
+        entry = json.loads(data)
+        return tuple(entry['result']) if entry['tuple'] else entry['result']
+    
+    def _store(self, key, data, now):
+        self._entries[key] = (now + self.ttl, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+    
+    def _read_disk(self, key, now):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            self._decode(data)
+            return data
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing, expired by another process, or not a cache entry
+            return None
+    
+    def _write_disk(self, key, data):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see half an entry
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+        except OSError as e:
+            print(f"Could not write cache entry {path}: {e}")
+    
+    def clear(self):
+        """Drop the entries held in memory"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        """Hit and miss counters"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
 
 class Shazam:
-    def __init__(self, db_file="songs.db"):
-        self.recorder = AudioRecorder()
-        self.analyzer = AudioAnalyzer()
-        self.db = Database(db_file)
+    # Progressive identification matches the query in slices of this many
+    # seconds and stops once the best song has PROGRESSIVE_MIN_ALIGNED
+    # aligned matches and leads the runner-up by PROGRESSIVE_MARGIN
+    PROGRESSIVE_SLICE_SECONDS = 1.0
+    PROGRESSIVE_MIN_ALIGNED = 20
+    PROGRESSIVE_MARGIN = 10
+    
+    def __init__(self, db_file="songs.db", in_memory=False, index_file=None,
+                 max_hash_postings=None, read_only=False, result_cache=None, index=None,
+                 **analyzer_options):
+        self._recorder = None
+        self.result_cache = result_cache
+        if in_memory or index_file or index is not None:
+            # A shared index is reused rather than loaded again
+            self.db = InMemoryDatabase(db_file, index_file=index_file,
+                                       max_hash_postings=max_hash_postings, read_only=read_only,
+                                       index=index)
+        else:
+            self.db = Database(db_file, max_hash_postings=max_hash_postings, read_only=read_only)
         self.db.initialize()
-        self.matcher = SongMatcher(self.db)
-        
-    def record_and_identify(self, record_seconds=10):
+        self.analyzer = self.db.create_analyzer(**analyzer_options)
+        self.matcher = SongMatcher(self.db, frame_duration=self.analyzer.get_offset_duration())
+    
+    @property
+    def recorder(self):
+        """The microphone recorder, opened on first use"""
+        if self._recorder is None:
+            self._recorder = AudioRecorder()
+        return self._recorder
+    
+    def record_and_identify(self, record_seconds=10, top_k=None):
         """Record audio and identify the song"""
         print("Starting recording...")
         audio_file = self.recorder.record("temp_recording.wav", record_seconds)
         
         if audio_file:
             print("Analyzing recorded audio...")
-            return self.identify_song(audio_file)
+            return self.identify_song(audio_file, top_k=top_k)
         else:
             print("Recording failed")
             return None
     
-    def identify_song(self, audio_file):
-        """Identify a song from an audio file"""
+    def identify_song(self, audio_file, top_k=None, progressive=False):
+        """Identify a song from an audio file
+        
+        With top_k, returns the list of ranked candidates from
+        SongMatcher.match instead of a single match. With progressive, the
+        file is matched slice by slice and reading stops as soon as the
+        result is clear (see match_progressive). Results are looked up in
+        and added to result_cache, if the instance has one.
+        """
+        return self.cached_result(
+            audio_file, lambda: self._identify_song(audio_file, top_k, progressive),
+            top_k=top_k, progressive=progressive)
+    
+    def cached_result(self, audio_file, compute, **params):
+        """Get the cached result of a query on audio_file, or compute and cache it
+        
+        params are the options that change the result, such as top_k. Without
+        a result cache, or if the file cannot be read, this just calls compute.
+        """
+        database_id = self.db.get_database_id()
+        if self.result_cache is None or database_id is None:
+            return compute()
+        try:
+            digest = ResultCache.file_digest(audio_file)
+        except OSError:
+            return compute()
+        
+        # The revision is read before computing, so a result is never older
+        # than the revision it is cached under
+        key = ResultCache.key(digest, self.analyzer.get_config(), database_id,
+                              self.db.get_revision(), **params)
+        found, result = self.result_cache.get(key)
+        if not found:
+            result = compute()
+            self.result_cache.put(key, result)
+        return result
+    
+    def _identify_song(self, audio_file, top_k=None, progressive=False):
         print(f"Identifying song from {audio_file}...")
         
+        if progressive:
+            accumulator = self.match_progressive(audio_file)
+            if accumulator is None:
+                return None
+            return self._match_result(accumulator, top_k)
+        
         # Read and analyze audio
-        audio_data = self.analyzer.read_audio(audio_file)
-        if audio_data is None:
+        result = self.analyzer.fingerprint_arrays(audio_file)
+        if result is None:
             return None
-            
-        fingerprints = self.analyzer.generate_fingerprint(audio_data)
         
-        if not fingerprints:
-            print("No fingerprints generated")
-            return None
+        hashes, offsets, duration = result
+        if self.analyzer.verbose:
+            print(f"Generated {len(hashes)} fingerprints")
+        return self.identify_fingerprints(hashes, offsets, top_k=top_k)
+    
+    def identify_fingerprints(self, hashes, offsets, top_k=None):
+        """Identify a song from hash and offset arrays
         
+        The arrays are those of AudioAnalyzer.fingerprint_arrays, so audio
+        can be fingerprinted elsewhere, such as in a worker process.
+        """
         # Match against database
-        result = self.matcher.match(fingerprints)
+        accumulator = MatchAccumulator()
+        self.matcher.add_match_arrays(accumulator, hashes, offsets)
+        return self._match_result(accumulator, top_k)
+    
+    def identify_fingerprint_batch(self, queries, top_k=None):
+        """Identify several queries of (hashes, offsets) arrays at once
+        
+        The hashes of all queries are resolved in a single lookup, whose
+        rows are then split between the queries. Returns one result per
+        query, as identify_fingerprints would.
+        """
+        all_hashes = np.concatenate([hashes for hashes, _ in queries] or [np.empty(0, dtype=np.int64)])
+        row_hashes, row_songs, row_offsets = self.db.find_match_arrays(np.unique(all_hashes))
+        
+        results = []
+        for hashes, offsets in queries:
+            rows = np.isin(row_hashes, hashes)
+            accumulator = MatchAccumulator()
+            accumulator.add(hashes, offsets, row_hashes[rows], row_songs[rows], row_offsets[rows])
+            results.append(self._match_result(accumulator, top_k))
+        return results
+    
+    def _match_result(self, accumulator, top_k=None):
+        """Get the match, or top_k candidates, of an identified query"""
+        if not accumulator.query_count:
+            print("No fingerprints generated")
+            return [] if top_k else None
+        if top_k:
+            return self.matcher.result(accumulator, top_k=top_k)
         
+        result = self.matcher.result(accumulator)
         if result:
             name, artist, confidence = result
             print(f"Match found with confidence: {confidence}")
@@ -424,24 +2082,44 @@ class Shazam:
         else:
             return None
     
+    def match_progressive(self, audio_file, min_aligned=None, margin=None, slice_seconds=None):
+        """Fingerprint and match a file in time-ordered slices
+        
+        Stops decoding once the best song has min_aligned aligned matches
+        and leads the runner-up by margin. Returns the MatchAccumulator, or
+        None if the file cannot be read.
+        """
+        min_aligned = self.PROGRESSIVE_MIN_ALIGNED if min_aligned is None else min_aligned
+        margin = self.PROGRESSIVE_MARGIN if margin is None else margin
+        slice_size = int((slice_seconds or self.PROGRESSIVE_SLICE_SECONDS) * self.analyzer.RATE)
+        
+        stream = FingerprintStream(self.analyzer)
+        accumulator = MatchAccumulator()
+        try:
+            for block in self.analyzer.stream_audio(audio_file, block_size=slice_size):
+                # Decoders that return the whole file at once are sliced here
+                for start in range(0, len(block), slice_size):
+                    self.matcher.add_match_arrays(accumulator, *stream.feed(block[start:start + slice_size]))
+                    if accumulator.is_decided(min_aligned, margin):
+                        print(f"Decided after {stream.num_samples / self.analyzer.RATE:.1f} seconds")
+                        return accumulator
+        except Exception as e:
+            print(f"Error reading audio file {audio_file}: {e}")
+            return None
+        
+        self.matcher.add_match_arrays(accumulator, *stream.flush())
+        return accumulator
+    
     def add_song_to_database(self, audio_file, name, artist, album=None):
         """Add a song to the database"""
         print(f"Adding '{name}' by {artist} to database...")
         
-        # Convert to WAV if necessary
-        if not audio_file.endswith('.wav'):
-            audio_file = self.analyzer.convert_audio_format(audio_file)
-            if not audio_file:
-                return None
-        
-        audio_data = self.analyzer.read_audio(audio_file)
-        if audio_data is None:
+        # Any format is decoded in memory; no converted copy is written
+        result = self.analyzer.fingerprint_file(audio_file)
+        if result is None:
             return None
             
-        # Calculate duration
-        duration = len(audio_data) / self.analyzer.RATE
-        
-        fingerprints = self.analyzer.generate_fingerprint(audio_data)
+        fingerprints, duration = result
         
         if fingerprints:
             return self.db.add_song(name, artist, audio_file, fingerprints, album, duration)
@@ -513,7 +2191,8 @@ class Shazam:
     
     def close(self):
         """Clean up resources"""
-        self.recorder.close()
+        if self._recorder is not None:
+            self._recorder.close()
         self.db.close()
 
 def main():
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Asyncio API server for the Shazam music recognition system
+Clients upload audio in the request body and it is identified while it
+arrives, instead of sending a file path on the server's disk
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from shazam import AudioAnalyzer, FingerprintStream, MatchAccumulator, Shazam
+from shazam_server import match_response
+
+WAV_TYPES = ('audio/wav', 'audio/wave', 'audio/x-wav', 'audio/vnd.wave')
+# Largest WAV header accepted before its data chunk starts
+MAX_WAV_HEADER = 1 << 20
+# Bytes read from the socket at a time
+READ_SIZE = 65536
+
+class HTTPError(Exception):
+    """Error that is sent to the client as a JSON response"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class StreamingIdentifier:
+    """Fingerprint and match one upload slice by slice as its bytes arrive
+
+    The body is a WAV file, or raw 16-bit little-endian PCM at the
+    database's sample rate (Content-Type audio/l16 or
+    application/octet-stream, with a channels query parameter for
+    interleaved multi-channel audio). WAV uploads must also use the
+    database's sample rate.
+    """
+    def __init__(self, server, content_type, params):
+        self.server = server
+        self.analyzer = server.analyzer
+        self.is_wav = content_type in WAV_TYPES
+        self.top_k = max(int(params.get('top_k', 3)), 2)
+        self.progressive = params.get('progressive', 'true').lower() not in ('0', 'false', 'no')
+
+        self.stream = FingerprintStream(self.analyzer)
+        self.accumulator = MatchAccumulator()
+        self.decided = False
+        self._header = bytearray()
+        self._pending = bytearray()
+        self._remaining = None
+        self._format = None
+        if not self.is_wav:
+            rate = int(params.get('rate', self.analyzer.RATE))
+            self._set_format(2, int(params.get('channels', 1)), rate)
+
+    def _set_format(self, sample_width, channels, rate):
+        if rate != self.analyzer.RATE:
+            raise HTTPError(415, f"Audio must be sampled at {self.analyzer.RATE} Hz, not {rate} Hz")
+        if channels < 1:
+            raise HTTPError(400, "channels must be at least 1")
+        self._format = (sample_width, channels)
+        frame_bytes = sample_width * channels
+        self._slice_bytes = int(Shazam.PROGRESSIVE_SLICE_SECONDS * rate) * frame_bytes
+
+    async def feed(self, data):
+        """Consume the next piece of the body, matching every complete slice"""
+        if self._format is None:
+            self._header += data
+            try:
+                header = AudioAnalyzer.parse_wav_header(self._header)
+            except ValueError as e:
+                raise HTTPError(415, str(e))
+            if header is None:
+                if len(self._header) > MAX_WAV_HEADER:
+                    raise HTTPError(415, "WAV header is too large")
+                return
+            sample_width, channels, rate, data_offset, self._remaining = header
+            self._set_format(sample_width, channels, rate)
+            data = bytes(self._header[data_offset:])
+            self._header = None
+
+        if self._remaining is not None:
+            # Ignore any chunks after the audio data
+            data = data[:self._remaining]
+            self._remaining -= len(data)
+        self._pending += data
+
+        while len(self._pending) >= self._slice_bytes and not self.decided:
+            chunk = bytes(self._pending[:self._slice_bytes])
+            del self._pending[:self._slice_bytes]
+            await self.server.run(self._match_slice, chunk, False)
+
+    async def finish(self):
+        """Match the rest of the upload and return the ranked candidates"""
+        if self._format is None:
+            raise HTTPError(415, "Incomplete WAV header")
+        if not self.decided:
+            frame_bytes = self._format[0] * self._format[1]
+            chunk = bytes(self._pending[:len(self._pending) - len(self._pending) % frame_bytes])
+            await self.server.run(self._match_slice, chunk, True)
+        return await self.server.run(self._result)
+
+    def _match_slice(self, shazam, chunk, final):
+        samples = AudioAnalyzer._pcm_to_mono(chunk, *self._format)
+        shazam.matcher.add_match_arrays(self.accumulator, *self.stream.feed(samples))
+        if final:
+            shazam.matcher.add_match_arrays(self.accumulator, *self.stream.flush())
+        if self.progressive:
+            self.decided = self.accumulator.is_decided(Shazam.PROGRESSIVE_MIN_ALIGNED,
+                                                       Shazam.PROGRESSIVE_MARGIN)
+
+    def _result(self, shazam):
+        if not self.accumulator.query_count:
+            return []
+        return shazam.matcher.result(self.accumulator, top_k=self.top_k)
+
+class AsyncShazamServer:
+    """HTTP/1.1 server on asyncio that identifies streamed uploads
+
+    Connections are coroutines, so idle clients cost little. Blocking
+    work (fingerprinting and lookups) runs on a pool of worker threads,
+    each with its own read-only Shazam instance, so matching of one slice
+    overlaps with the upload of the next.
+    """
+    def __init__(self, shazam_options=None, workers=8):
+        self.shazam_options = shazam_options or {}
+        # Create or migrate the database before any reader opens it, and
+        # load any index once for all of them
+        shazam = Shazam(**self.shazam_options)
+        self.analyzer = shazam.analyzer
+        self.index = getattr(shazam.db, 'index', None)
+        shazam.close()
+
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='shazam-worker')
+        self._local = threading.local()
+
+    def get_shazam(self):
+        """Get the read-only Shazam instance of the current worker thread"""
+        shazam = getattr(self._local, 'shazam', None)
+        if shazam is None:
+            shazam = Shazam(read_only=True, index=self.index, **self.shazam_options)
+            self._local.shazam = shazam
+        return shazam
+
+    async def run(self, func, *args):
+        """Run func(shazam, *args) on a worker thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(self.get_shazam(), *args))
+
+    async def handle_client(self, reader, writer):
+        """Serve the requests of one connection until it is closed"""
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """Serve one request, returning whether the connection stays open"""
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return False
+
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self._send_json(writer, {'success': False, 'error': 'Bad request'}, 400, False)
+            return False
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (headers.get('connection', '').lower() != 'close'
+                      and version == 'HTTP/1.1')
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = self._iter_body(reader, headers)
+
+        try:
+            if method == 'GET' and url.path == '/':
+                data = {
+                    'message': 'Shazam Streaming API Server',
+                    'endpoints': ['POST /identify - Identify uploaded WAV or raw PCM audio'],
+                }
+                status = 200
+            elif method == 'POST' and url.path == '/identify':
+                data = await self._identify(body, headers, params, writer, keep_alive)
+                status = 200
+            else:
+                raise HTTPError(404, 'Endpoint not found')
+        except HTTPError as e:
+            data, status = {'success': False, 'error': str(e)}, e.status
+        except Exception as e:
+            print(f"Error in {method} {url.path}: {e}")
+            data, status = {'success': False, 'error': str(e)}, 500
+
+        # Read whatever the handler left so the next request starts cleanly
+        async for _ in body:
+            pass
+        if data is not None:
+            await self._send_json(writer, data, status, keep_alive)
+        return keep_alive
+
+    async def _identify(self, body, headers, params, writer, keep_alive):
+        """Identify an upload as it arrives
+
+        When progressive matching decides early, the response is sent at
+        once and the rest of the body is read and discarded. Returns the
+        response, or None if it has already been sent.
+        """
+        content_type = headers.get('content-type', 'application/octet-stream').split(';')[0].strip()
+        identifier = StreamingIdentifier(self, content_type.lower(), params)
+
+        async for data in body:
+            await identifier.feed(data)
+            if identifier.decided:
+                await self._send_json(writer, match_response(await identifier.finish()),
+                                      200, keep_alive)
+                return None
+        return match_response(await identifier.finish())
+
+    async def _iter_body(self, reader, headers):
+        """Yield the request body in pieces as they arrive
+
+        Handles both Content-Length and chunked transfer encoding.
+        """
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = await reader.readline()
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # Skip trailers up to the blank line ending the body
+                    while (await reader.readline()).strip():
+                        pass
+                    return
+                while size > 0:
+                    data = await reader.read(min(size, READ_SIZE))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', size)
+                    size -= len(data)
+                    yield data
+                await reader.readline()
+        else:
+            remaining = int(headers.get('content-length', 0))
+            while remaining > 0:
+                data = await reader.read(min(remaining, READ_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(data)
+                yield data
+
+    async def _send_json(self, writer, data, status, keep_alive):
+        body = json.dumps(data).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                  415: 'Unsupported Media Type', 500: 'Internal Server Error'}.get(status, '')
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            "Content-Type: application/json\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+
+    def close(self):
+        """Stop the worker threads"""
+        self.executor.shutdown(wait=True)
+
+    async def serve(self, host='0.0.0.0', port=8001):
+        """Accept connections until cancelled"""
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"🎵 Shazam streaming API server listening on port {port}")
+        async with server:
+            await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Shazam streaming API server')
+    parser.add_argument('--port', type=int, default=8001, help='Port to run server on (default: 8001)')
+    parser.add_argument('--db', default='songs.db', help='Database file (default: songs.db)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Threads for fingerprinting and lookups (default: 8)')
+    parser.add_argument('--index-file',
+                        help='Memory-map fingerprints from an index file written by shazam_index.py')
+    parser.add_argument('--max-hash-postings', type=int,
+                        help='Skip fingerprint hashes stored more often than this at query time')
+    args = parser.parse_args()
+
+    server = AsyncShazamServer({
+        'db_file': args.db,
+        'index_file': args.index_file,
+        'max_hash_postings': args.max_hash_postings,
+    }, workers=args.workers)
+    try:
+        asyncio.run(server.serve(port=args.port))
+    except KeyboardInterrupt:
+        print("\n🛑 Server stopped by user")
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Export the fingerprints of a Shazam database to a memory-mappable index file
+Servers started with --index-file map the file instead of loading SQLite
+"""
+
+import argparse
+import sys
+
+from shazam import Database, FingerprintIndex
+
+def export_index(db_file, index_file):
+    """Write the fingerprints of db_file to index_file"""
+    db = Database(db_file)
+    db.initialize()
+    try:
+        index = db.export_index(index_file)
+    finally:
+        db.close()
+
+    print(f"Exported {len(index)} fingerprints from {db_file} to {index_file}")
+    return index
+
+def show_index(index_file):
+    """Print the header of an index file"""
+    count, metadata, _ = FingerprintIndex.read_header(index_file)
+    print(f"Fingerprints: {count}")
+    print(f"Songs: {metadata.get('song_count')}")
+    print(f"Fingerprint settings: {metadata.get('fingerprint_config')}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Shazam fingerprint index files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export a database to an index file')
+    export_parser.add_argument('index_file', help='Index file to write')
+    export_parser.add_argument('--db', default='songs.db', help='Database file (default: songs.db)')
+
+    info_parser = subparsers.add_parser('info', help='Show the header of an index file')
+    info_parser.add_argument('index_file', help='Index file to read')
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'export':
+            export_index(args.db, args.index_file)
+        else:
+            show_index(args.index_file)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Bulk ingestion for the Shazam music recognition system
+Fingerprints many files in parallel worker processes and writes them to the
+database from a single writer, many songs per transaction
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from shazam import AudioAnalyzer, Database
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.m4a', '.aac', '.aiff', '.aif')
+
+def read_manifest(source):
+    """Read the songs to ingest from a directory or a CSV/JSONL manifest
+
+    Returns a list of dicts with path, name, artist and album. Files in a
+    directory are named after the file, with an unknown artist. Relative
+    paths in a manifest are resolved against the manifest's directory.
+    """
+    if os.path.isdir(source):
+        entries = []
+        for root, _, files in os.walk(source):
+            for filename in sorted(files):
+                if filename.lower().endswith(AUDIO_EXTENSIONS):
+                    entries.append({
+                        'path': os.path.join(root, filename),
+                        'name': os.path.splitext(filename)[0],
+                        'artist': 'Unknown Artist',
+                        'album': None,
+                    })
+        return sorted(entries, key=lambda entry: entry['path'])
+
+    with open(source, newline='', encoding='utf-8') as f:
+        if source.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        elif source.lower().endswith(('.jsonl', '.ndjson')):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            raise ValueError(f"Unsupported manifest format: {source}")
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    entries = []
+    for line_number, row in enumerate(rows, 1):
+        if not row.get('path') or not row.get('name') or not row.get('artist'):
+            raise ValueError(f"{source}: entry {line_number} needs path, name and artist")
+        entries.append({
+            'path': os.path.join(base_dir, row['path']),
+            'name': row['name'],
+            'artist': row['artist'],
+            'album': row.get('album') or None,
+        })
+    return entries
+
+def ingest(db_file, entries, workers=None, batch_size=100, verbose=True, **analyzer_options):
+    """Fingerprint and add many songs to a database
+
+    Files are fingerprinted by a pool of worker processes while this
+    process writes the results, committing every batch_size songs. At most
+    a few files per worker are in flight, so memory stays bounded however
+    long the manifest is. Returns a dict of counts and throughput.
+    """
+    db = Database(db_file, verbose=False)
+    db.initialize()
+    config = db.create_analyzer(**analyzer_options).get_config()
+    workers = workers or os.cpu_count() or 1
+
+    stats = {'files': 0, 'failed': 0, 'hashes': 0}
+    start = time.perf_counter()
+    pending_commit = 0
+
+    def report():
+        elapsed = time.perf_counter() - start
+        stats['seconds'] = elapsed
+        stats['files_per_second'] = stats['files'] / elapsed if elapsed else 0.0
+        stats['hashes_per_second'] = stats['hashes'] / elapsed if elapsed else 0.0
+        if verbose:
+            print(f"Ingested {stats['files']} files ({stats['failed']} failed), "
+                  f"{stats['files_per_second']:.1f} files/s, "
+                  f"{stats['hashes_per_second']:.0f} hashes/s")
+
+    try:
+        with ProcessPoolExecutor(workers, initializer=AudioAnalyzer.init_worker,
+                                 initargs=(config,)) as executor:
+            max_in_flight = 4 * workers
+            remaining = iter(entries)
+            in_flight = {}
+
+            while True:
+                for entry in remaining:
+                    future = executor.submit(AudioAnalyzer.fingerprint_in_worker, entry['path'])
+                    in_flight[future] = entry
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = in_flight.pop(future)
+                    result = future.result()
+                    if result is None:
+                        stats['failed'] += 1
+                        continue
+                    hashes, offsets, duration = result
+
+                    db.add_song(entry['name'], entry['artist'], entry['path'],
+                                list(zip(hashes.tolist(), offsets.tolist())),
+                                album=entry['album'], duration=duration, commit=False)
+                    stats['files'] += 1
+                    stats['hashes'] += len(hashes)
+                    pending_commit += 1
+
+                    if pending_commit >= batch_size:
+                        db.conn.commit()
+                        pending_commit = 0
+                        report()
+
+        db.conn.commit()
+    finally:
+        db.close()
+
+    report()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk-add songs to a Shazam database')
+    parser.add_argument('source', help='Directory of audio files, or a CSV/JSONL manifest '
+                                       'with path, name, artist and album columns')
+    parser.add_argument('--db', default='songs.db', help='Database file (default: songs.db)')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Songs written per transaction (default: 100)')
+    parser.add_argument('--quiet', action='store_true', help='Only print the final summary')
+    args = parser.parse_args()
+
+    try:
+        entries = read_manifest(args.source)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    print(f"Ingesting {len(entries)} files into {args.db}...")
+    stats = ingest(args.db, entries, workers=args.workers, batch_size=args.batch_size,
+                   verbose=not args.quiet)
+    if args.quiet:
+        print(f"Ingested {stats['files']} files ({stats['failed']} failed) in "
+              f"{stats['seconds']:.1f}s, {stats['hashes_per_second']:.0f} hashes/s")
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,13 @@ Provides REST API endpoints for music recognition
 """
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import base64
 import json
+import multiprocessing
 import urllib.parse
 import os
+import socket
 import sys
 import threading
 import time
@@ -16,16 +20,190 @@ import time
 sys.path.append('/Users/samandersony/StudioProjects/projects/shazam')
 
 try:
-    from shazam import Shazam
+    from shazam import AudioAnalyzer, ResultCache, Shazam
     print("✅ Shazam module imported successfully")
 except ImportError as e:
     print(f"❌ Failed to import Shazam module: {e}")
     sys.exit(1)
 
+def match_response(candidates):
+    """Build the response to an identification from its ranked candidates
+    
+    Reports the best candidate, the ranked candidates and the margin of the
+    best aligned count over the runner-up's.
+    """
+    if candidates:
+        best = candidates[0]
+        runner_up = candidates[1]['aligned'] if len(candidates) > 1 else 0
+        return {
+            'success': True,
+            'name': best['name'],
+            'artist': best['artist'],
+            'confidence': best['aligned'],
+            'query_ratio': best['query_ratio'],
+            'song_ratio': best['song_ratio'],
+            'offset': best['offset'],
+            'margin': best['aligned'] - runner_up,
+            'candidates': candidates,
+            'is_match': True
+        }
+    return {
+        'success': True,
+        'name': 'No Match',
+        'artist': 'Unknown',
+        'confidence': 0,
+        'candidates': [],
+        'is_match': False
+    }
+
+# After a 503, what the client still sends is read and discarded, up to
+# this many bytes and seconds, as closing a socket with unread data resets
+# the connection before the client sees the response
+REJECT_DRAIN_LIMIT = 1 << 20
+REJECT_DRAIN_SECONDS = 0.5
+REJECT_THREADS = 4
+
+def _fingerprint_clip(clip, analyzer=None):
+    """Fingerprint one clip of a batch, given as a file_path or base64 WAV audio
+    
+    Runs in a fingerprinting process unless an analyzer is given. Raises
+    ValueError if the clip cannot be read.
+    """
+    analyzer = analyzer or AudioAnalyzer.worker
+    if clip.get('audio'):
+        return analyzer.fingerprint_wav_bytes(base64.b64decode(clip['audio']))
+    
+    result = analyzer.fingerprint_arrays(clip['file_path'])
+    if result is None:
+        raise ValueError(f"Could not read {clip['file_path']}")
+    return result
+
+class ShazamHTTPServer(HTTPServer):
+    """HTTP server that handles requests on a bounded pool of threads
+    
+    Connections beyond queue_depth are answered with 503; songs are added
+    by a single writer thread.
+    """
+    def __init__(self, server_address, handler_class, shazam_options=None, max_workers=8,
+                 fingerprint_workers=None, queue_depth=32, result_cache=None):
+        super().__init__(server_address, handler_class)
+        self.shazam_options = shazam_options or {}
+        self.result_cache = result_cache
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='shazam-worker')
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='shazam-writer')
+        self.rejecter = ThreadPoolExecutor(REJECT_THREADS, thread_name_prefix='shazam-rejecter')
+        self._local = threading.local()
+        self._writer_shazam = None
+        
+        # Create or migrate the database before any reader opens it
+        def prepare(shazam):
+            shazam.db.enable_wal()
+            return shazam.analyzer.get_config(), getattr(shazam.db, 'index', None)
+        config, self.index = self.write(prepare)
+        
+        if fingerprint_workers is None:
+            fingerprint_workers = os.cpu_count() or 1
+        self.fingerprint_pool = None
+        self._queue_slots = threading.BoundedSemaphore(queue_depth)
+        self._reject_slots = threading.BoundedSemaphore(queue_depth)
+        if fingerprint_workers > 0:
+            # Spawned rather than forked, as this process already runs threads
+            self.fingerprint_pool = ProcessPoolExecutor(
+                fingerprint_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=AudioAnalyzer.init_worker, initargs=(config,)
+            )
+            # Start the processes now rather than on the first request
+            self.fingerprint_pool.submit(os.getpid).result()
+    
+    def process_request(self, request, client_address):
+        """Hand the connection to the worker pool, or reject it if the queue is full"""
+        if self._queue_slots.acquire(blocking=False):
+            self.executor.submit(self._process_request_thread, request, client_address)
+        elif self._reject_slots.acquire(blocking=False):
+            self.rejecter.submit(self._reject_request, request)
+        else:
+            self.shutdown_request(request)
+    
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._queue_slots.release()
+    
+    def _reject_request(self, request):
+        """Answer a connection with 503 without reading its request"""
+        body = json.dumps({'success': False, 'error': 'Server is busy, try again later'}).encode()
+        try:
+            request.settimeout(REJECT_DRAIN_SECONDS)
+            request.sendall(
+                b"HTTP/1.0 503 Service Unavailable\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Access-Control-Allow-Origin: *\r\n"
+                b"Retry-After: 1\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            request.shutdown(socket.SHUT_WR)
+            
+            deadline = time.monotonic() + REJECT_DRAIN_SECONDS
+            drained = 0
+            while drained < REJECT_DRAIN_LIMIT:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                request.settimeout(remaining)
+                data = request.recv(65536)
+                if not data:
+                    break
+                drained += len(data)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+            self._reject_slots.release()
+    
+    def get_shazam(self):
+        """Get the read-only Shazam instance of the current worker thread"""
+        shazam = getattr(self._local, 'shazam', None)
+        if shazam is None:
+            shazam = Shazam(read_only=True, result_cache=self.result_cache, index=self.index,
+                            **self.shazam_options)
+            self._local.shazam = shazam
+        return shazam
+    
+    def write(self, func):
+        """Run func(shazam) on the writer thread and return its result"""
+        return self.writer.submit(self._run_writer, func).result()
+    
+    def fingerprint(self, file_path):
+        """Fingerprint a file in the process pool
+        
+        Returns (hashes, offsets, duration) arrays, or None if the file
+        cannot be read.
+        """
+        return self.fingerprint_pool.submit(AudioAnalyzer.fingerprint_in_worker, file_path).result()
+    
+    def _run_writer(self, func):
+        if self._writer_shazam is None:
+            self._writer_shazam = Shazam(**self.shazam_options)
+        return func(self._writer_shazam)
+    
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        self.rejecter.shutdown(wait=True)
+        if self.fingerprint_pool is not None:
+            self.fingerprint_pool.shutdown(wait=True)
+
 class ShazamHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.shazam = Shazam()
-        super().__init__(*args, **kwargs)
+    @property
+    def shazam(self):
+        """Read-only Shazam instance for this request's worker thread"""
+        return self.server.get_shazam()
     
     def _set_cors_headers(self):
         """Set CORS headers for cross-origin requests"""
@@ -63,13 +241,21 @@ class ShazamHandler(BaseHTTPRequestHandler):
                     'version': '1.0.0',
                     'endpoints': [
                         'GET /songs - List all songs',
+                        'GET /stats - Result cache statistics',
                         'POST /identify - Identify song from file',
+                        'POST /identify-batch - Identify many clips, streaming NDJSON results',
                         'POST /add-song - Add song to database',
                         'POST /record-identify - Record and identify'
                     ]
                 })
             elif self.path == '/songs':
                 self._handle_get_songs()
+            elif self.path == '/stats':
+                cache = self.server.result_cache
+                self._send_json_response({
+                    'success': True,
+                    'result_cache': cache.stats() if cache else None
+                })
             else:
                 self._send_error_response('Endpoint not found', 404)
         except Exception as e:
@@ -85,6 +271,8 @@ class ShazamHandler(BaseHTTPRequestHandler):
             
             if self.path == '/identify':
                 self._handle_identify_song(data)
+            elif self.path == '/identify-batch':
+                self._handle_identify_batch(data)
             elif self.path == '/add-song':
                 self._handle_add_song(data)
             elif self.path == '/record-identify':
@@ -137,28 +325,127 @@ class ShazamHandler(BaseHTTPRequestHandler):
                 return
             
             print(f"🔍 Identifying song from: {file_path}")
-            result = self.shazam.identify_song(file_path)
-            
-            if result:
-                name, artist, confidence = result
-                self._send_json_response({
-                    'success': True,
-                    'name': name,
-                    'artist': artist,
-                    'confidence': confidence,
-                    'is_match': True
-                })
+            top_k = self._get_top_k(data)
+            progressive = bool(data.get('progressive', False))
+            if progressive or self.server.fingerprint_pool is None:
+                # Progressive matching interleaves decoding with lookups
+                candidates = self.shazam.identify_song(file_path, top_k=top_k,
+                                                       progressive=progressive)
             else:
-                self._send_json_response({
-                    'success': True,
-                    'name': 'No Match',
-                    'artist': 'Unknown',
-                    'confidence': 0,
-                    'is_match': False
-                })
+                def identify():
+                    arrays = self.server.fingerprint(file_path)
+                    if arrays is None:
+                        return None
+                    hashes, offsets, duration = arrays
+                    return self.shazam.identify_fingerprints(hashes, offsets, top_k=top_k)
+                # Shares cache entries with identify_song, which gives the same result
+                candidates = self.shazam.cached_result(file_path, identify,
+                                                       top_k=top_k, progressive=False)
+            self._send_match_response(candidates)
         except Exception as e:
             self._send_error_response(f"Failed to identify song: {e}")
     
+    def _get_top_k(self, data):
+        """Number of ranked candidates requested, at least two for the margin"""
+        return max(int(data.get('top_k', 3)), 2)
+    
+    def _send_match_response(self, candidates):
+        """Send the response to an identification"""
+        self._send_json_response(match_response(candidates))
+    
+    def _handle_identify_batch(self, data):
+        """Identify a list of clips, streaming one NDJSON result per clip
+        
+        Each clip is {"id": ..., "file_path": ...} or {"id": ..., "audio":
+        base64 WAV}. Clips are fingerprinted in parallel; whenever some
+        finish, all of their hashes are resolved in one lookup and their
+        results are written straight away, in completion order.
+        """
+        clips = data.get('clips')
+        if not isinstance(clips, list) or not clips:
+            self._send_error_response('clips must be a non-empty list', 400)
+            return
+        for index, clip in enumerate(clips):
+            if not isinstance(clip, dict) or not (clip.get('file_path') or clip.get('audio')):
+                self._send_error_response(f'clip {index} needs a file_path or audio', 400)
+                return
+        top_k = self._get_top_k(data)
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self._set_cors_headers()
+        self.end_headers()
+        
+        # Once streaming has started, errors become result lines, so every
+        # clip gets exactly one line and the stream still ends cleanly
+        unreported = set(range(len(clips)))
+        try:
+            for wave in self._fingerprint_waves(clips):
+                self._write_batch_results(clips, wave, top_k)
+                unreported.difference_update(index for index, _, _ in wave)
+        except ConnectionError:
+            # The client went away; nobody is left to tell
+            return
+        except Exception as e:
+            print(f"Error in batch identification: {e}")
+            for index in sorted(unreported):
+                self._write_ndjson({'id': clips[index].get('id', index), 'success': False,
+                                    'error': str(e)})
+    
+    def _fingerprint_waves(self, clips):
+        """Fingerprint the clips of a batch, yielding them in waves as they finish
+        
+        Each wave is a list of (index, arrays, error). Without a process
+        pool the clips are fingerprinted one at a time in this thread.
+        """
+        pool = self.server.fingerprint_pool
+        if pool is None:
+            for index, clip in enumerate(clips):
+                try:
+                    yield [(index, _fingerprint_clip(clip, self.shazam.analyzer), None)]
+                except Exception as e:
+                    yield [(index, None, e)]
+            return
+        
+        pending = {pool.submit(_fingerprint_clip, clip): index for index, clip in enumerate(clips)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            wave = []
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                wave.append((index, None if error else future.result(), error))
+            yield sorted(wave, key=lambda item: item[0])
+    
+    def _write_batch_results(self, clips, wave, top_k):
+        """Match a wave of fingerprinted clips in one lookup and write their results"""
+        queries, finished = [], []
+        for index, arrays, error in wave:
+            clip_id = clips[index].get('id', index)
+            if error is not None:
+                self._write_ndjson({'id': clip_id, 'success': False, 'error': str(error)})
+                continue
+            hashes, offsets, duration = arrays
+            queries.append((hashes, offsets))
+            finished.append(clip_id)
+        
+        if not queries:
+            return
+        try:
+            results = self.shazam.identify_fingerprint_batch(queries, top_k=top_k)
+        except Exception as e:
+            print(f"Error in batch identification: {e}")
+            for clip_id in finished:
+                self._write_ndjson({'id': clip_id, 'success': False, 'error': str(e)})
+            return
+        for clip_id, candidates in zip(finished, results):
+            self._write_ndjson(dict({'id': clip_id}, **match_response(candidates)))
+    
+    def _write_ndjson(self, data):
+        """Write one line of a streamed NDJSON response"""
+        self.wfile.write(json.dumps(data).encode() + b'\n')
+        self.wfile.flush()
+    
     def _handle_add_song(self, data):
         """Add song to database"""
         try:
@@ -176,7 +463,9 @@ class ShazamHandler(BaseHTTPRequestHandler):
                 return
             
             print(f"📚 Adding song to database: {name} by {artist}")
-            song_id = self.shazam.add_song_to_database(file_path, name, artist, album)
+            song_id = self.server.write(
+                lambda shazam: shazam.add_song_to_database(file_path, name, artist, album)
+            )
             
             if song_id:
                 self._send_json_response({
@@ -195,25 +484,8 @@ class ShazamHandler(BaseHTTPRequestHandler):
             duration = data.get('duration', 10)
             
             print(f"🎤 Recording for {duration} seconds...")
-            result = self.shazam.record_and_identify(duration)
-            
-            if result:
-                name, artist, confidence = result
-                self._send_json_response({
-                    'success': True,
-                    'name': name,
-                    'artist': artist,
-                    'confidence': confidence,
-                    'is_match': True
-                })
-            else:
-                self._send_json_response({
-                    'success': True,
-                    'name': 'No Match',
-                    'artist': 'Unknown',
-                    'confidence': 0,
-                    'is_match': False
-                })
+            candidates = self.shazam.record_and_identify(duration, top_k=self._get_top_k(data))
+            self._send_match_response(candidates)
         except Exception as e:
             self._send_error_response(f"Failed to record and identify: {e}")
     
@@ -221,31 +493,31 @@ class ShazamHandler(BaseHTTPRequestHandler):
         """Override to customize logging"""
         print(f"🌐 {self.address_string()} - {format % args}")
 
-def run_server(port=8000):
+def run_server(port=8000, in_memory=False, index_file=None, max_hash_postings=None, workers=8,
+               fingerprint_workers=None, queue_depth=32, cache_size=1024, cache_ttl=3600,
+               cache_dir=None):
     """Run the HTTP server"""
     # Bind to all interfaces so Android emulator can connect
     server_address = ('0.0.0.0', port)
     
-    # Create a custom handler class that includes the Shazam instance
-    class CustomShazamHandler(ShazamHandler):
-        def __init__(self, *args, **kwargs):
-            # Initialize Shazam instance once for the server
-            if not hasattr(CustomShazamHandler, 'shazam_instance'):
-                print("🔧 Initializing Shazam instance...")
-                CustomShazamHandler.shazam_instance = Shazam()
-                print("✅ Shazam instance ready")
-            
-            self.shazam = CustomShazamHandler.shazam_instance
-            BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
-    
-    httpd = HTTPServer(server_address, CustomShazamHandler)
+    print("🔧 Initializing Shazam database...")
+    result_cache = ResultCache(cache_size, cache_ttl, cache_dir) if cache_size > 0 else None
+    httpd = ShazamHTTPServer(server_address, ShazamHandler, {
+        'in_memory': in_memory,
+        'index_file': index_file,
+        'max_hash_postings': max_hash_postings,
+    }, max_workers=workers, fingerprint_workers=fingerprint_workers, queue_depth=queue_depth,
+       result_cache=result_cache)
+    print("✅ Shazam database ready")
     
-    print(f"🎵 Shazam API Server starting on port {port}")
+    print(f"🎵 Shazam API Server starting on port {port} with {workers} worker threads")
     print(f"🌐 Server URL: http://localhost:{port}")
     print("📋 Available endpoints:")
     print("   GET  /           - Server info")
     print("   GET  /songs      - List all songs")
+    print("   GET  /stats      - Result cache statistics")
     print("   POST /identify   - Identify song from file")
+    print("   POST /identify-batch - Identify many clips (NDJSON results)")
     print("   POST /add-song   - Add song to database")
     print("   POST /record-identify - Record and identify")
     print("\n🚀 Server is ready! Press Ctrl+C to stop.\n")
@@ -261,6 +533,27 @@ if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description='Shazam API Server')
     parser.add_argument('--port', type=int, default=8000, help='Port to run server on (default: 8000)')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Load all fingerprints into memory for faster lookups')
+    parser.add_argument('--index-file',
+                        help='Memory-map fingerprints from an index file written by shazam_index.py')
+    parser.add_argument('--max-hash-postings', type=int,
+                        help='Skip fingerprint hashes stored more often than this at query time')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of request worker threads (default: 8)')
+    parser.add_argument('--fingerprint-workers', type=int,
+                        help='Fingerprinting processes (default: CPU count, 0 to fingerprint in threads)')
+    parser.add_argument('--queue-depth', type=int, default=32,
+                        help='Connections that may wait for a worker thread before returning 503 (default: 32)')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='Identification results cached in memory (default: 1024, 0 to disable)')
+    parser.add_argument('--cache-ttl', type=float, default=3600,
+                        help='Seconds a cached result stays valid (default: 3600)')
+    parser.add_argument('--cache-dir',
+                        help='Also keep cached results in this directory, across restarts')
     args = parser.parse_args()
     
-    run_server(args.port)
+    run_server(args.port, in_memory=args.in_memory, index_file=args.index_file,
+               max_hash_postings=args.max_hash_postings, workers=args.workers,
+               fingerprint_workers=args.fingerprint_workers, queue_depth=args.queue_depth,
+               cache_size=args.cache_size, cache_ttl=args.cache_ttl, cache_dir=args.cache_dir)
@@ -72,5 +72,917 @@ def test_basic_functionality():
         import traceback
         traceback.print_exc()
 
+def create_melody(duration=10, sample_rate=44100, seed=0):
+    """Create a pseudo-random melody so every part of the clip is distinct"""
+    rng = np.random.default_rng(seed)
+    note_length = int(sample_rate * 0.25)
+    notes = []
+    for _ in range(int(duration / 0.25)):
+        t = np.arange(note_length) / sample_rate
+        freqs = rng.uniform(100, 1900, size=3)
+        note = sum(np.sin(2 * np.pi * f * t) for f in freqs)
+        notes.append(note)
+    audio = np.concatenate(notes)
+    audio = audio / np.max(np.abs(audio)) * 0.8
+    return (audio * 32767).astype(np.int16)
+
+def test_stft_engine_matches_chunked():
+    """The batched STFT engine must produce the same fingerprints as the loop"""
+    from shazam import AudioAnalyzer
+    
+    audio = create_melody(duration=5)
+    settings = [{"fingerprint_version": version, "pairing": "adjacent"}
+                for version in AudioAnalyzer.FINGERPRINT_VERSIONS]
+    settings.append({"pairing": "target_zone"})
+    
+    for options in settings:
+        stft = AudioAnalyzer(engine="stft", **options).generate_fingerprint(audio)
+        chunked = AudioAnalyzer(engine="chunked", **options).generate_fingerprint(audio)
+        
+        assert len(stft) > 0
+        assert stft == chunked
+
+def reference_find_peaks(analyzer, fft_data, min_freq=40, max_freq=2000):
+    """Original per-bin peak picking loop, kept as a reference"""
+    peaks = {}
+    freq_to_bin = lambda f: int(f * len(fft_data) * 2 / analyzer.RATE)
+    min_bin = freq_to_bin(min_freq)
+    max_bin = min(freq_to_bin(max_freq), len(fft_data) - 1)
+    for i in range(min_bin + 1, max_bin - 1):
+        if (fft_data[i] > fft_data[i-1] and
+            fft_data[i] > fft_data[i+1] and
+            fft_data[i] > np.mean(fft_data) * 2):
+            freq = i * analyzer.RATE / (2 * len(fft_data))
+            range_idx = analyzer.get_index(freq)
+            if range_idx not in peaks or fft_data[i] > peaks[range_idx][1]:
+                peaks[range_idx] = (freq, fft_data[i])
+    return peaks
+
+def test_vectorized_peaks_match_reference():
+    """find_peaks and find_peaks_matrix must agree with the original loop"""
+    from shazam import AudioAnalyzer
+    
+    analyzer = AudioAnalyzer()
+    frames = analyzer.frame_audio(create_melody(duration=3, seed=1))
+    spectrogram = analyzer.get_spectrogram(frames)
+    frame_idx, range_idx, freqs, mags = analyzer.find_peaks_matrix(spectrogram)
+    
+    for row, fft_data in enumerate(spectrogram):
+        expected = reference_find_peaks(analyzer, fft_data)
+        assert analyzer.find_peaks(fft_data) == expected
+        
+        in_row = frame_idx == row
+        from_matrix = {int(r): (f, m) for r, f, m in
+                       zip(range_idx[in_row], freqs[in_row], mags[in_row])}
+        assert from_matrix == expected
+
+def write_wav(filename, audio, sample_rate=44100):
+    """Write mono 16-bit audio to a WAV file"""
+    import wave
+    with wave.open(filename, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(audio.tobytes())
+    return filename
+
+def test_partial_clip_matches(tmp_path):
+    """A clip cut from the middle of a song must be identified"""
+    song = create_melody(duration=20, seed=2)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    decoy_file = write_wav(str(tmp_path / "decoy.wav"), create_melody(duration=20, seed=3))
+    # Start the clip off the analysis frame grid
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[int(44100 * 7.3):int(44100 * 13.3)])
+    
+    shazam = Shazam(str(tmp_path / "songs.db"))
+    try:
+        shazam.add_song_to_database(song_file, "Melody", "Test Artist")
+        shazam.add_song_to_database(decoy_file, "Decoy", "Test Artist")
+        
+        result = shazam.identify_song(clip_file)
+        assert result is not None
+        assert result[:2] == ("Melody", "Test Artist")
+    finally:
+        shazam.close()
+
+def test_fingerprint_version_is_per_database(tmp_path):
+    """The fingerprint scheme is recorded when a database is created"""
+    db_file = str(tmp_path / "songs.db")
+    shazam = Shazam(db_file, fingerprint_version=1, pairing="adjacent")
+    shazam.close()
+    
+    shazam = Shazam(db_file)
+    assert shazam.analyzer.fingerprint_version == 1
+    assert shazam.analyzer.pairing == "adjacent"
+    shazam.close()
+
+def test_packed_hashes():
+    """Version 3 keys are bit-packed integers that fit in 32 bits"""
+    from shazam import AudioAnalyzer
+    
+    analyzer = AudioAnalyzer(fingerprint_version=3)
+    keys = analyzer.hash_pairs(np.array([440.0, 1990.0]), np.array([880.0, 45.0]), np.array([0, 3]))
+    
+    assert keys.tolist() == [
+        analyzer.hash_constellation(440.0, 880.0, 0),
+        analyzer.hash_constellation(1990.0, 45.0, 3),
+    ]
+    assert keys[0] == (220 << 22) | (440 << 12)
+    assert np.all(keys < 2 ** 32)
+
+def test_target_zone_pairing():
+    """Each anchor pairs with at most fan_value peaks from later frames"""
+    from shazam import AudioAnalyzer
+    
+    analyzer = AudioAnalyzer(fan_value=3, target_zone_start=1, target_zone_frames=4)
+    frame_idx = np.repeat(np.arange(10), 4)
+    freqs = np.tile([100.0, 400.0, 900.0, 1600.0], 10)
+    mags = np.arange(40, dtype=float)
+    anchors, targets = analyzer._pair_target_zone(frame_idx, freqs, mags)
+    
+    deltas = frame_idx[targets] - frame_idx[anchors]
+    assert np.all((deltas >= 1) & (deltas <= 4))
+    assert np.all(np.abs(freqs[targets] - freqs[anchors]) <= analyzer.target_zone_freq)
+    assert np.bincount(anchors).max() == 3
+    # The first anchor pairs with the strongest reachable peaks of frames 1-4
+    assert sorted(targets[anchors == 0].tolist()) == [16, 17, 18]
+
+def test_overlapping_frames():
+    """Frames advance by hop_size and offsets are integer frame indices"""
+    from shazam import AudioAnalyzer
+    
+    analyzer = AudioAnalyzer(chunk_size=8, hop_size=2)
+    audio = np.arange(20, dtype=np.int16)
+    frames = analyzer.frame_audio(audio)
+    
+    assert frames.shape == (7, 8)
+    assert np.shares_memory(frames, audio)
+    assert frames[3].tolist() == list(range(6, 14))
+    
+    fingerprints = AudioAnalyzer().generate_fingerprint(create_melody(duration=3))
+    assert all(isinstance(offset, int) for _, offset in fingerprints)
+
+def test_decimated_front_end_finds_same_peaks():
+    """Decimating before the FFT keeps frame timing and peak frequencies"""
+    from shazam import AudioAnalyzer
+    
+    def peaks(audio, decimate):
+        analyzer = AudioAnalyzer(decimate=decimate)
+        frames = analyzer.frame_audio(analyzer.decimate_audio(audio))
+        frame_idx, _, freqs, _ = analyzer.find_peaks_matrix(analyzer.get_spectrogram(frames))
+        return set(zip(frame_idx.tolist(), freqs.tolist()))
+    
+    assert AudioAnalyzer(decimate=True).DECIMATION == 4
+    audio = create_melody(duration=10, seed=4)
+    full, decimated = peaks(audio, False), peaks(audio, True)
+    assert len(full & decimated) > 0.95 * len(full)
+    assert len(decimated) < 1.05 * len(full)
+    
+    # Energy above the analysis Nyquist frequency is missing from the
+    # decimated threshold, so broadband audio gains peaks but loses none
+    rng = np.random.default_rng(4)
+    t = np.arange(len(audio)) / 44100
+    broadband = (audio * 0.5 + 3000 * np.sin(2 * np.pi * 8000 * t)
+                 + rng.normal(0, 1500, len(audio))).clip(-32767, 32767).astype(np.int16)
+    full, decimated = peaks(broadband, False), peaks(broadband, True)
+    assert len(full & decimated) > 0.98 * len(full)
+    assert len(decimated) > 1.5 * len(full)
+
+def test_streaming_matches_whole_signal():
+    """Fingerprinting block by block gives the same result as all at once"""
+    from shazam import AudioAnalyzer
+    
+    audio = create_melody(duration=8, seed=5)
+    blocks = [audio[i:i + 10000] for i in range(0, len(audio), 10000)]
+    
+    for options in ({}, {"pairing": "adjacent"}, {"decimate": True}):
+        analyzer = AudioAnalyzer(**options)
+        assert analyzer.generate_fingerprint_stream(blocks) == analyzer.generate_fingerprint(audio)
+
+def test_stereo_wav_is_downmixed(tmp_path):
+    """Multi-channel WAV files are averaged to mono, not read interleaved"""
+    import wave
+    from shazam import AudioAnalyzer
+    
+    left = create_melody(duration=2, seed=6)
+    right = left // 2
+    filename = str(tmp_path / "stereo.wav")
+    with wave.open(filename, 'wb') as wf:
+        wf.setnchannels(2)
+        wf.setsampwidth(2)
+        wf.setframerate(44100)
+        wf.writeframes(np.column_stack([left, right]).tobytes())
+    
+    analyzer = AudioAnalyzer()
+    expected = ((left.astype(np.int32) + right) // 2).astype(np.int16)
+    assert np.array_equal(analyzer.read_audio(filename), expected)
+    assert np.array_equal(np.concatenate(list(analyzer.stream_wav(filename, 5000))), expected)
+
+def test_wav_is_memory_mapped(tmp_path):
+    """Mono 16-bit WAV samples are read through a zero-copy memory map"""
+    import struct
+    import pytest
+    from shazam import AudioAnalyzer
+    
+    audio = create_melody(duration=2, seed=7)
+    filename = write_wav(str(tmp_path / "mono.wav"), audio)
+    
+    analyzer = AudioAnalyzer()
+    data, sample_width, channels, frame_rate = analyzer.map_wav(filename)
+    assert isinstance(data, np.memmap)
+    assert (sample_width, channels, frame_rate) == (2, 1, 44100)
+    
+    samples = analyzer.read_audio(filename)
+    assert isinstance(samples.base, np.memmap)
+    assert np.array_equal(samples, audio)
+    
+    # Large chunks before the data chunk, and malformed fmt chunks
+    fmt = struct.pack('<HHIIHH', 1, 1, 44100, 88200, 2, 16)
+    body = (b'WAVE' + b'LIST' + struct.pack('<I', 10001) + b'\0' * 10002
+            + b'fmt ' + struct.pack('<I', 16) + fmt
+            + b'data' + struct.pack('<I', len(audio) * 2) + audio.tobytes())
+    with open(filename, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+    assert np.array_equal(np.asarray(analyzer.map_wav(filename)[0]).view(np.int16), audio)
+    
+    short = b'RIFF\0\0\0\0WAVEfmt ' + struct.pack('<I', 4) + fmt[:4] + b'data\0\0\0\0'
+    with open(filename, 'wb') as f:
+        f.write(short)
+    for parse in (lambda: analyzer.map_wav(filename), lambda: AudioAnalyzer.parse_wav_header(short)):
+        with pytest.raises(ValueError):
+            parse()
+
+def test_ffmpeg_decode_leaves_no_files(tmp_path):
+    """Non-native input is decoded through an ffmpeg pipe, not a temp WAV"""
+    import shutil
+    import pytest
+    from shazam import AudioAnalyzer
+    
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("ffmpeg is not installed")
+    
+    # A 22.05 kHz WAV cannot be memory-mapped as-is and needs resampling
+    filename = write_wav(str(tmp_path / "low_rate.wav"), create_melody(duration=2), sample_rate=22050)
+    analyzer = AudioAnalyzer()
+    audio = np.concatenate(list(analyzer.stream_audio(filename)))
+    
+    assert abs(len(audio) - 4 * 44100) < 100
+    assert sorted(os.listdir(tmp_path)) == ["low_rate.wav"]
+
+def test_lookup_modes_handle_long_queries(tmp_path):
+    """Both lookup modes return the same rows, beyond SQLite's variable limit"""
+    from shazam import Database
+    
+    fingerprints = [(h, h % 50) for h in range(0, 80000, 2)]
+    query = [(h, 0) for h in range(0, 80000, 3)] * 2
+    
+    results = []
+    for lookup in Database.LOOKUP_MODES:
+        db = Database(str(tmp_path / f"{lookup}.db"), lookup=lookup)
+        db.initialize()
+        db.add_song("Song", "Artist", "song.wav", fingerprints)
+        results.append(sorted(db.find_matches(query)))
+        db.close()
+    
+    expected = sorted((h, 1, h % 50) for h in range(0, 80000, 6))
+    assert results[0] == results[1] == expected
+
+def legacy_fingerprints(song):
+    """Fingerprints as databases that stored offsets in seconds hold them"""
+    from shazam import AudioAnalyzer
+    
+    analyzer = AudioAnalyzer(**dict(AudioAnalyzer.LEGACY_CONFIG, offset_unit="frames"))
+    seconds = analyzer.HOP_SIZE / analyzer.RATE
+    return [(h, frame * seconds) for h, frame in analyzer.generate_fingerprint(song.astype(float))]
+
+def test_legacy_schema_is_migrated(tmp_path):
+    """Old fingerprint tables are rebuilt clustered with frame offsets"""
+    import sqlite3
+    from shazam import AudioAnalyzer, Database
+    
+    song = create_melody(duration=10, seed=4)
+    fingerprints = legacy_fingerprints(song)
+    
+    db_file = str(tmp_path / "songs.db")
+    conn = sqlite3.connect(db_file)
+    conn.executescript('''
+        CREATE TABLE songs (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,
+            artist TEXT NOT NULL, album TEXT, file_path TEXT NOT NULL, duration REAL,
+            date_added TEXT NOT NULL, fingerprint_count INTEGER DEFAULT 0);
+        CREATE TABLE fingerprints (hash INTEGER NOT NULL, song_id INTEGER NOT NULL,
+            offset REAL NOT NULL);
+        CREATE INDEX idx_fingerprints_hash ON fingerprints (hash);
+        CREATE INDEX idx_fingerprints_song ON fingerprints (song_id);
+        INSERT INTO songs (name, artist, file_path, date_added)
+            VALUES ('Melody', 'Test Artist', 'song.wav', '2024-01-01');
+    ''')
+    conn.executemany("INSERT INTO fingerprints VALUES (?, 1, ?)", fingerprints)
+    conn.commit()
+    conn.close()
+    
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[:44100 * 5])
+    shazam = Shazam(db_file)
+    try:
+        sql = shazam.db.cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'fingerprints'").fetchone()[0]
+        assert "WITHOUT ROWID" in sql
+        assert shazam.db.get_schema_version() == Database.SCHEMA_VERSION
+        assert shazam.db.cursor.execute(
+            "SELECT DISTINCT typeof(offset) FROM fingerprints").fetchall() == [("integer",)]
+        assert shazam.analyzer.offset_unit == "frames"
+        assert shazam.db.cursor.execute("SELECT SUM(count) FROM hash_counts").fetchone() == \
+            shazam.db.cursor.execute("SELECT COUNT(*) FROM fingerprints").fetchone()
+        
+        result = shazam.identify_song(clip_file)
+        assert result is not None
+        assert result[:2] == ("Melody", "Test Artist")
+    finally:
+        shazam.close()
+
+def test_seconds_offsets_are_converted(tmp_path):
+    """Databases that store offsets in seconds are converted to frames when opened"""
+    import pytest
+    from shazam import AudioAnalyzer, Database
+    
+    with pytest.raises(ValueError):
+        AudioAnalyzer(offset_unit="seconds")
+    
+    song = create_melody(duration=10, seed=4)
+    db_file = str(tmp_path / "songs.db")
+    db = Database(db_file)
+    db.initialize()
+    db.save_fingerprint_config(dict(AudioAnalyzer.LEGACY_CONFIG, fingerprint_version=1))
+    db.add_song("Melody", "Test Artist", "song.wav", legacy_fingerprints(song))
+    db.close()
+    
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[:44100 * 5])
+    results = []
+    for in_memory in (False, True):
+        shazam = Shazam(db_file, in_memory=in_memory)
+        try:
+            assert shazam.analyzer.offset_unit == "frames"
+            assert shazam.db.cursor.execute(
+                "SELECT DISTINCT typeof(offset) FROM fingerprints").fetchall() == [("integer",)]
+            results.append(shazam.identify_song(clip_file, top_k=2)[0])
+        finally:
+            shazam.close()
+    assert results[0]["aligned"] == results[1]["aligned"]
+    assert results[0]["offset"] == results[1]["offset"] == 0.0
+
+def test_song_info_cache(tmp_path):
+    """Song metadata is cached per id and dropped when the song is deleted"""
+    from shazam import Database
+    
+    db = Database(str(tmp_path / "songs.db"))
+    db.initialize()
+    db.SONG_CACHE_SIZE = 2
+    song_ids = [db.add_song(f"Song {i}", "Artist", "song.wav", [(i, 0)]) for i in range(3)]
+    try:
+        for song_id in song_ids:
+            assert db.get_song_info(song_id)[0] == f"Song {song_id - 1}"
+        assert list(db._song_cache) == song_ids[1:]
+        
+        db.delete_song(song_ids[2])
+        assert db.get_song_info(song_ids[2]) is None
+        assert list(db._song_cache) == song_ids[1:2]
+    finally:
+        db.close()
+
+def test_in_memory_backend_matches_sqlite(tmp_path):
+    """The in-memory index returns the same rows as SQLite, and stays in sync"""
+    from shazam import Database, InMemoryDatabase
+    
+    rng = np.random.default_rng(5)
+    songs = [[(int(h), int(t)) for h, t in zip(rng.integers(0, 2000, 3000), rng.integers(0, 400, 3000))]
+             for _ in range(3)]
+    query = [(int(h), 0) for h in rng.integers(0, 2500, 800)]
+    
+    db_file = str(tmp_path / "songs.db")
+    db = Database(db_file)
+    db.initialize()
+    db.add_song("Song 1", "Artist", "song1.wav", songs[0])
+    db.close()
+    
+    memory_db = InMemoryDatabase(db_file)
+    memory_db.initialize()
+    memory_db.add_song("Song 2", "Artist", "song2.wav", songs[1])
+    memory_db.add_song("Song 3", "Artist", "song3.wav", songs[2])
+    memory_db.delete_song(2)
+    
+    db = Database(db_file)
+    db.initialize()
+    try:
+        assert len(memory_db.index) == db.cursor.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+        assert sorted(memory_db.find_matches(query)) == sorted(db.find_matches(query))
+        assert {song_id for _, song_id, _ in memory_db.find_matches(query)} == {1, 3}
+    finally:
+        db.close()
+        memory_db.close()
+
+def test_in_memory_identify(tmp_path):
+    """Songs are identified the same way with the in-memory backend"""
+    song_file = write_wav(str(tmp_path / "song.wav"), create_melody(duration=10, seed=6))
+    clip_file = write_wav(str(tmp_path / "clip.wav"), create_melody(duration=10, seed=6)[44100 * 2:44100 * 7])
+    
+    shazam = Shazam(str(tmp_path / "songs.db"))
+    shazam.add_song_to_database(song_file, "Melody", "Test Artist")
+    shazam.close()
+    
+    shazam = Shazam(str(tmp_path / "songs.db"), in_memory=True)
+    try:
+        result = shazam.identify_song(clip_file)
+        assert result is not None
+        assert result[:2] == ("Melody", "Test Artist")
+    finally:
+        shazam.close()
+
+def test_index_file_round_trip(tmp_path):
+    """Exported index files are memory-mapped and rejected once out of date"""
+    from shazam import Database, FingerprintIndex, InMemoryDatabase
+    
+    db_file = str(tmp_path / "songs.db")
+    index_file = str(tmp_path / "songs.idx")
+    db = Database(db_file)
+    db.initialize()
+    db.add_song("Song 1", "Artist", "song1.wav", [(h * 7 % 1000, h) for h in range(500)])
+    db.add_song("Song 2", "Artist", "song2.wav", [(h * 3 % 1000, h) for h in range(500)])
+    exported = db.export_index(index_file)
+    db.close()
+    
+    loaded = FingerprintIndex.load(index_file)
+    assert isinstance(loaded.hashes.base, np.memmap)
+    assert loaded.metadata["song_count"] == 2
+    for column in ("hashes", "song_ids", "offsets"):
+        assert np.array_equal(getattr(loaded, column), getattr(exported, column))
+    
+    query = [(h, 0) for h in range(0, 1000, 5)]
+    memory_db = InMemoryDatabase(db_file, index_file=index_file)
+    memory_db.initialize()
+    assert isinstance(memory_db.index.hashes.base, np.memmap)
+    matches = sorted(memory_db.find_matches(query))
+    memory_db.delete_song(1)
+    memory_db.close()
+    
+    # The file still holds song 1, so it is ignored in favour of SQLite
+    memory_db = InMemoryDatabase(db_file, index_file=index_file)
+    memory_db.initialize()
+    try:
+        assert not isinstance(memory_db.index.hashes.base, np.memmap)
+        assert sorted(memory_db.find_matches(query)) == [m for m in matches if m[1] == 2]
+    finally:
+        memory_db.close()
+    
+    # A database with the same song counts but another catalog ignores it too
+    other_file = str(tmp_path / "other.db")
+    other_db = Database(other_file)
+    other_db.initialize()
+    other_db.add_song("Other 1", "Artist", "other1.wav", [(h, h) for h in range(500)])
+    other_db.add_song("Other 2", "Artist", "other2.wav", [(h, h) for h in range(500)])
+    other_db.close()
+    memory_db = InMemoryDatabase(other_file, index_file=index_file)
+    memory_db.initialize()
+    try:
+        assert not isinstance(memory_db.index.hashes.base, np.memmap)
+        assert len(memory_db.index) == 1000
+    finally:
+        memory_db.close()
+
+def test_vectorized_scoring(tmp_path):
+    """Scores match a per-pair histogram, counting repeated query hashes"""
+    from collections import Counter
+    from shazam import SongMatcher
+    
+    rng = np.random.default_rng(7)
+    query_hashes = rng.integers(0, 300, 400)
+    query_offsets = rng.integers(0, 100, 400)
+    hashes = rng.integers(0, 300, 2000)
+    song_ids = rng.integers(1, 20, 2000)
+    offsets = rng.integers(0, 500, 2000)
+    
+    pairs = Counter()
+    for h, song_id, offset in zip(hashes, song_ids, offsets):
+        for query_offset in query_offsets[query_hashes == h]:
+            pairs[song_id, offset - query_offset] += 1
+    expected = {}
+    for (song_id, _), count in pairs.items():
+        expected[song_id] = max(expected.get(song_id, 0), count)
+    
+    songs, aligned, total, _ = SongMatcher.score(query_hashes, query_offsets, hashes, song_ids, offsets,
+                                              min_matches=0)
+    assert dict(zip(songs.tolist(), aligned.tolist())) == expected
+    assert total.sum() == sum(pairs.values())
+    
+    # A hash heard twice in the query aligns twice
+    db_file = str(tmp_path / "songs.db")
+    shazam = Shazam(db_file)
+    try:
+        shazam.db.add_song("Song", "Artist", "song.wav", [(1, 10), (2, 12), (3, 14)])
+        result = shazam.matcher.match([(1, 0), (2, 2), (3, 4), (1, 7), (2, 9), (3, 11)], min_matches=1)
+        assert result == ("Song", "Artist", 3)
+        result = shazam.matcher.match([(1, 0), (1, 5), (2, 2), (3, 4)], min_matches=4)
+        assert result == ("Song", "Artist", 3)
+    finally:
+        shazam.close()
+
+def test_top_k_candidates(tmp_path):
+    """Ranked candidates report ratios and the clip's position in the track"""
+    song = create_melody(duration=20, seed=8)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    cover_file = write_wav(str(tmp_path / "cover.wav"), np.concatenate([song[:44100 * 8], create_melody(duration=12, seed=9)]))
+    decoy_file = write_wav(str(tmp_path / "decoy.wav"), create_melody(duration=20, seed=10))
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[44100 * 4:44100 * 12])
+    
+    shazam = Shazam(str(tmp_path / "songs.db"))
+    try:
+        shazam.add_song_to_database(song_file, "Melody", "Test Artist")
+        shazam.add_song_to_database(cover_file, "Cover", "Test Artist")
+        shazam.add_song_to_database(decoy_file, "Decoy", "Test Artist")
+        
+        candidates = shazam.identify_song(clip_file, top_k=2)
+        assert [c["name"] for c in candidates] == ["Melody", "Cover"]
+        best, runner_up = candidates
+        assert best["aligned"] > runner_up["aligned"] > 0
+        assert best["hits"] >= best["aligned"]
+        assert 0 < best["query_ratio"] <= 1 and 0 < best["song_ratio"] <= 1
+        assert abs(best["offset"] - 4) < 0.1
+        assert abs(runner_up["offset"] - 4) < 0.1
+        
+        assert shazam.identify_song(clip_file)[:2] == ("Melody", "Test Artist")
+    finally:
+        shazam.close()
+
+def test_stop_hashes_are_skipped(tmp_path):
+    """Hashes with long posting lists are counted and left out of lookups"""
+    from shazam import Database, InMemoryDatabase
+    
+    db_file = str(tmp_path / "songs.db")
+    db = Database(db_file)
+    db.initialize()
+    for song in range(4):
+        db.add_song(f"Song {song}", "Artist", "song.wav",
+                    [(999, 0), (999, 5), (999, 5), (song, 1), (10 + song, 2)])
+    db.delete_song(4)
+    assert db.cursor.execute("SELECT count FROM hash_counts WHERE hash = 999").fetchone() == (6,)
+    assert db.cursor.execute("SELECT hash FROM hash_counts WHERE hash IN (3, 13)").fetchall() == []
+    db.close()
+    
+    query = [(999, 0), (0, 0), (1, 0), (12, 0)]
+    expected = [(0, 1, 1), (1, 2, 1), (12, 3, 2)]
+    for backend in (Database(db_file, "temp_table", 5), Database(db_file, "chunked", 5),
+                    InMemoryDatabase(db_file, max_hash_postings=5)):
+        backend.initialize()
+        try:
+            assert sorted(backend.find_matches(query)) == expected
+            backend.max_hash_postings = 6
+            assert len(backend.find_matches(query)) == 9
+        finally:
+            backend.close()
+
+def test_progressive_identify(tmp_path):
+    """Progressive matching stops early, and otherwise equals a full match"""
+    song = create_melody(duration=30, seed=11)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    decoy_file = write_wav(str(tmp_path / "decoy.wav"), create_melody(duration=30, seed=12))
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[int(44100 * 5.5):44100 * 25])
+    
+    shazam = Shazam(str(tmp_path / "songs.db"))
+    try:
+        shazam.add_song_to_database(song_file, "Melody", "Test Artist")
+        shazam.add_song_to_database(decoy_file, "Decoy", "Test Artist")
+        
+        accumulator = shazam.match_progressive(clip_file)
+        assert accumulator.is_decided(shazam.PROGRESSIVE_MIN_ALIGNED, shazam.PROGRESSIVE_MARGIN)
+        assert accumulator.query_count < len(shazam.analyzer.fingerprint_file(clip_file)[0]) / 4
+        assert shazam.identify_song(clip_file, progressive=True)[:2] == ("Melody", "Test Artist")
+        
+        # Never decided early, the slices add up to the whole query
+        accumulator = shazam.match_progressive(clip_file, min_aligned=10 ** 9, slice_seconds=0.7)
+        assert shazam.matcher.result(accumulator) == shazam.identify_song(clip_file)
+    finally:
+        shazam.close()
+
+def test_bulk_ingest(tmp_path):
+    """Manifests are fingerprinted in worker processes and written in batches"""
+    from shazam_ingest import ingest, read_manifest
+    
+    songs = [create_melody(duration=8, seed=30 + i) for i in range(3)]
+    for i, song in enumerate(songs):
+        write_wav(str(tmp_path / f"song{i}.wav"), song)
+    with open(tmp_path / "manifest.jsonl", "w") as f:
+        for i in range(3):
+            f.write(f'{{"path": "song{i}.wav", "name": "Song {i}", "artist": "Artist"}}\n')
+        f.write('{"path": "missing.wav", "name": "Missing", "artist": "Artist"}\n')
+    
+    entries = read_manifest(str(tmp_path / "manifest.jsonl"))
+    assert len(read_manifest(str(tmp_path))) == 3
+    
+    db_file = str(tmp_path / "songs.db")
+    stats = ingest(db_file, entries, workers=2, batch_size=2)
+    assert (stats["files"], stats["failed"]) == (3, 1)
+    assert stats["hashes"] > 0 and stats["files_per_second"] > 0
+    
+    clip_file = write_wav(str(tmp_path / "clip.wav"), songs[1][44100 * 2:44100 * 6])
+    shazam = Shazam(db_file)
+    try:
+        assert len(shazam.db.get_all_songs()) == 3
+        assert shazam.identify_song(clip_file)[:2] == ("Song 1", "Artist")
+    finally:
+        shazam.close()
+
+def test_threaded_server(tmp_path, monkeypatch):
+    """Requests are served concurrently from read-only per-thread connections"""
+    import json
+    import socket
+    import threading
+    import urllib.error
+    import pytest
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from shazam_server import ShazamHandler, ShazamHTTPServer
+    
+    song = create_melody(duration=10, seed=40)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[44100 * 2:44100 * 6])
+    
+    httpd = ShazamHTTPServer(("127.0.0.1", 0), ShazamHandler,
+                             {"db_file": str(tmp_path / "songs.db")}, max_workers=4,
+                             fingerprint_workers=2, queue_depth=8)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    
+    def post(path, data):
+        request = urllib.request.Request(f"http://127.0.0.1:{httpd.server_port}{path}",
+                                         data=json.dumps(data).encode(), method="POST")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+    
+    try:
+        added = post("/add-song", {"file_path": song_file, "name": "Melody", "artist": "Test Artist"})
+        assert added["success"]
+        
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: post("/identify", {"file_path": clip_file}), range(8)))
+        assert all(result["name"] == "Melody" for result in results)
+        
+        # Connections beyond the queue depth are turned away: slow clients
+        # hold all four workers and the four queue places left
+        slow_clients = [socket.create_connection(("127.0.0.1", httpd.server_port))
+                        for _ in range(8)]
+        try:
+            for client in slow_clients:
+                client.sendall(b"POST /identify HTTP/1.0\r\n")
+            
+            # The 503 is sent without waiting for the request, so clients
+            # that never send one do not hold up the others
+            idle_clients = [socket.create_connection(("127.0.0.1", httpd.server_port))
+                            for _ in range(8)]
+            for client in idle_clients:
+                client.settimeout(5)
+                assert client.makefile("rb").read().startswith(b"HTTP/1.0 503")
+                client.close()
+            with pytest.raises(urllib.error.HTTPError) as error:
+                post("/identify", {"file_path": clip_file})
+            assert error.value.code == 503
+            
+            # The queued clients are still served once they finish their requests
+            body = json.dumps({"file_path": clip_file}).encode()
+            for client in slow_clients:
+                client.sendall(b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            for client in slow_clients:
+                response = client.makefile("rb").read()
+                assert response.startswith(b"HTTP/1.0 200")
+                assert json.loads(response.split(b"\r\n\r\n", 1)[1])["name"] == "Melody"
+        finally:
+            for client in slow_clients:
+                client.close()
+        assert post("/identify", {"file_path": clip_file, "progressive": True})["name"] == "Melody"
+
+        # A batch streams one NDJSON line per clip, including failed ones
+        import base64
+        with open(clip_file, "rb") as f:
+            audio = base64.b64encode(f.read()).decode()
+        clips = [{"id": "path", "file_path": clip_file}, {"id": "inline", "audio": audio},
+                 {"id": "missing", "file_path": str(tmp_path / "missing.wav")}]
+        request = urllib.request.Request(f"http://127.0.0.1:{httpd.server_port}/identify-batch",
+                                         data=json.dumps({"clips": clips}).encode(), method="POST")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            assert response.headers["Content-Type"] == "application/x-ndjson"
+            lines = {line["id"]: line for line in map(json.loads, response.read().splitlines())}
+        assert sorted(lines) == ["inline", "missing", "path"]
+        assert lines["path"]["name"] == lines["inline"]["name"] == "Melody"
+        assert not lines["missing"]["success"]
+        
+        # Lookup errors after the stream has started become result lines
+        def fail(self, queries, top_k=None):
+            raise RuntimeError("lookup failed")
+        monkeypatch.setattr(Shazam, "identify_fingerprint_batch", fail)
+        with urllib.request.urlopen(request, timeout=30) as response:
+            lines = [json.loads(line) for line in response.read().splitlines()]
+        assert sorted(line["id"] for line in lines) == ["inline", "missing", "path"]
+        assert not any(line["success"] for line in lines)
+        monkeypatch.undo()
+
+        stats = json.loads(urllib.request.urlopen(
+            f"http://127.0.0.1:{httpd.server_port}/stats", timeout=30).read())
+        assert stats["result_cache"] is None
+        
+        journal_mode = httpd.write(lambda shazam: shazam.db.cursor.execute("PRAGMA journal_mode").fetchone()[0])
+        assert journal_mode == "wal"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_in_memory_server_sees_added_songs(tmp_path):
+    """Songs added through the server are matched by readers that share its index"""
+    import json
+    import threading
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    from shazam_server import ShazamHandler, ShazamHTTPServer
+    
+    song = create_melody(duration=10, seed=45)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[44100 * 2:44100 * 6])
+    
+    httpd = ShazamHTTPServer(("127.0.0.1", 0), ShazamHandler,
+                             {"db_file": str(tmp_path / "songs.db"), "in_memory": True},
+                             max_workers=2, fingerprint_workers=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    
+    def post(path, data):
+        request = urllib.request.Request(f"http://127.0.0.1:{httpd.server_port}{path}",
+                                         data=json.dumps(data).encode(), method="POST")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+    
+    try:
+        # Every reader thread opens its instance before the song exists
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: post("/identify", {"file_path": clip_file}), range(4)))
+        assert all(result["name"] == "No Match" for result in results)
+        
+        assert post("/add-song", {"file_path": song_file, "name": "Melody", "artist": "Test Artist"})["success"]
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: post("/identify", {"file_path": clip_file}), range(4)))
+        assert all(result["name"] == "Melody" for result in results)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_async_server_streams_uploads(tmp_path, monkeypatch):
+    """Uploaded WAV and raw PCM bodies are identified, chunked or not"""
+    import asyncio
+    import http.client
+    import json
+    import threading
+    from shazam import FingerprintIndex
+    from shazam_async_server import AsyncShazamServer
+    
+    song = create_melody(duration=20, seed=50)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    clip = song[int(44100 * 3.3):44100 * 15]
+    clip_file = write_wav(str(tmp_path / "clip.wav"), clip)
+    
+    db_file = str(tmp_path / "songs.db")
+    shazam = Shazam(db_file)
+    shazam.add_song_to_database(song_file, "Melody", "Test Artist")
+    shazam.close()
+    
+    # Without its index file, the index is loaded from SQLite once for all workers
+    loads = []
+    from_database = FingerprintIndex.from_database
+    monkeypatch.setattr(FingerprintIndex, "from_database",
+                        classmethod(lambda cls, db: loads.append(db) or from_database(db)))
+    server = AsyncShazamServer({"db_file": db_file, "index_file": str(tmp_path / "missing.idx")},
+                               workers=2)
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(asyncio.start_server(server.handle_client, "127.0.0.1", 0))
+    port = listener.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    
+    def post(path, body, content_type, chunked=False):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            if chunked:
+                pieces = (body[i:i + 10000] for i in range(0, len(body), 10000))
+                conn.request("POST", path, body=pieces, encode_chunked=True,
+                             headers={"Content-Type": content_type})
+            else:
+                conn.request("POST", path, body=body, headers={"Content-Type": content_type})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+    
+    try:
+        with open(clip_file, "rb") as f:
+            wav = f.read()
+        status, result = post("/identify?progressive=false", wav, "audio/wav", chunked=True)
+        assert status == 200 and result["name"] == "Melody"
+        assert result["confidence"] == shazam_result(db_file, clip_file)
+        
+        status, result = post("/identify", clip.tobytes(), "audio/l16")
+        assert status == 200 and result["name"] == "Melody"
+        
+        stereo = np.repeat(clip, 2)
+        status, result = post("/identify?channels=2", stereo.tobytes(), "audio/l16", chunked=True)
+        assert status == 200 and result["name"] == "Melody"
+        
+        status, result = post("/identify?rate=8000", clip.tobytes(), "audio/l16")
+        assert status == 415
+        assert len(loads) == 1
+    finally:
+        async def stop():
+            listener.close()
+            await listener.wait_closed()
+            await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}))
+        asyncio.run_coroutine_threadsafe(stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        server.close()
+
+def shazam_result(db_file, clip_file):
+    """Aligned count of the best match for a file"""
+    shazam = Shazam(db_file)
+    try:
+        return shazam.identify_song(clip_file)[2]
+    finally:
+        shazam.close()
+
+def test_result_cache(tmp_path):
+    """Repeated identifications are served from the cache until the database changes"""
+    from shazam import ResultCache
+    
+    song = create_melody(duration=10, seed=60)
+    song_file = write_wav(str(tmp_path / "song.wav"), song)
+    clip_file = write_wav(str(tmp_path / "clip.wav"), song[44100 * 2:44100 * 6])
+    
+    cache = ResultCache(max_entries=2, ttl=60, cache_dir=str(tmp_path / "cache"))
+    shazam = Shazam(str(tmp_path / "songs.db"), result_cache=cache)
+    try:
+        shazam.add_song_to_database(song_file, "Melody", "Test Artist")
+        first = shazam.identify_song(clip_file, top_k=3)
+        assert first[0]["name"] == "Melody"
+        assert shazam.identify_song(clip_file, top_k=3) == first
+        assert (cache.hits, cache.misses) == (1, 1)
+        
+        # Results are copies, and differ per top_k
+        first[0]["name"] = "Changed"
+        assert shazam.identify_song(clip_file, top_k=3)[0]["name"] == "Melody"
+        shazam.identify_song(clip_file, top_k=2)
+        assert (cache.hits, cache.misses) == (2, 2)
+        
+        # Entries outlive the memory tier on disk
+        cache.clear()
+        assert shazam.identify_song(clip_file, top_k=3)[0]["name"] == "Melody"
+        assert cache.stats()["disk_hits"] == 1
+        
+        # Adding a song changes the revision, so nothing is reused
+        revision = shazam.db.get_revision()
+        shazam.add_song_to_database(clip_file, "Clip", "Test Artist")
+        assert shazam.db.get_revision() == revision + 1
+        shazam.identify_song(clip_file, top_k=3)
+        assert cache.misses == 3
+        
+        # Expired entries are not returned from memory or disk
+        cache.ttl = 0
+        cache.clear()
+        shazam.identify_song(clip_file, top_k=3)
+        shazam.identify_song(clip_file, top_k=3)
+        assert cache.misses == 5
+    finally:
+        shazam.close()
+
+def test_result_cache_is_per_database(tmp_path):
+    """Databases at the same revision never see each other's cached results"""
+    from shazam import ResultCache
+    
+    songs = [create_melody(duration=10, seed=seed) for seed in (61, 62)]
+    clip_file = write_wav(str(tmp_path / "clip.wav"), songs[0][44100 * 2:44100 * 6])
+    cache_dir = str(tmp_path / "cache")
+    
+    results = []
+    for index, song in enumerate(songs):
+        song_file = write_wav(str(tmp_path / f"song{index}.wav"), song)
+        # A fresh cache each time, so results can only be shared on disk
+        shazam = Shazam(str(tmp_path / f"songs{index}.db"), in_memory=True,
+                        result_cache=ResultCache(cache_dir=cache_dir))
+        try:
+            shazam.add_song_to_database(song_file, f"Song {index}", "Test Artist")
+            assert shazam.db.get_revision() == shazam.db.index.revision == 1
+            results.append(shazam.identify_song(clip_file))
+            # Tuples survive the JSON round trip through the disk tier
+            shazam.result_cache.clear()
+            assert shazam.identify_song(clip_file) == results[-1]
+            assert shazam.result_cache.disk_hits == 1
+        finally:
+            shazam.close()
+    
+    assert isinstance(results[0], tuple) and results[0][0] == "Song 0"
+    assert results[1] is None or results[1][0] == "Song 1"
+
 if __name__ == "__main__":
     test_basic_functionality()